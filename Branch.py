@@ -3,161 +3,643 @@ import bank_pb2
 import bank_pb2_grpc
 import time
 import pdb
-import json
+import logging
+import queue
+import resource
+import threading
+import collections
+import contextlib
+import heapq
+import itertools
+import os
 from utilities import configure_logger, get_operation_name, get_result_name, get_source_type_name
+from channel_pool import get_channel_pool
+from hash_ring import HashRing
+from write_log import WriteLog
+from dedup_cache import DedupCache
+from wal import WriteAheadLog, list_segments, load_snapshot, read_segments, remove_segments, write_snapshot
+from op_log import OperationLog, WRITE, QUERY, get_op_log_file_name, get_request_seq
+from metrics import MetricsRegistry, SIZE_BUCKETS, timed_lock
 from concurrent import futures
 
 logger = configure_logger("Branch")
 
+def get_time_remaining(context):
+    """
+    Seconds left before the deadline of the request, None if it has no deadline
+    gRPC reports a request without a deadline as a time remaining too large to wait on.
+    """
+    if context is None:
+        return None
+    remaining = context.time_remaining()
+    if remaining is None or remaining > threading.TIMEOUT_MAX:
+        return None
+    return remaining
+
 class Branch(bank_pb2_grpc.BankServicer):
 
-    def __init__(self, id, balance, branches, bind_addresses):
+    def __init__(self, id, balance, branches, bind_addresses, propagate_policy="all", propagate_timeout=5.0, propagate_retries=3, lock_stripes=16, propagate_batch_size=1, session_wait=0.0, sync_interval=0.0, transport=None, replication_factor=0, customer_admission_limit=0, branch_admission_limit=0, worker_slots=0, history_size=100, dedup_size=10000, dedup_ttl=60.0, data_dir=None, wal_sync_interval=0.0, snapshot_interval=1000, op_log_dir=None):
         # unique ID of the Branch
         self.id = id
         # replica of the Branch's balance
         self.balance = balance
         # the list of process IDs of the branches
         self.branches = branches
-        # the list of Client stubs to communicate with the branches
-        self.stubList = list()
-        # a list of received messages used for debugging purpose
-        self.events = list()
+        # the last history_size received messages used for debugging purpose
+        self.events = collections.deque(maxlen=history_size)
         # iterate the processID of the branches
         self.branches_bind_addresses = bind_addresses
         # local clock
         self.clock = 1
         # write_id
         self.write_id = 0
-        # write_set based on customer id
+        # write_set version vector based on customer id, branch id -> number of the customer writes from the branch
         self.write_set = {}
+        # propagated writes arrived ahead of their dependencies based on customer id
+        self.pending_writes = {}
+        # applied writes based on (customer id, origin branch id), in origin order, served to lagging branches by Sync
+        self.write_log = {}
+        # writes acknowledged by the other replicas based on customer id, branch id -> write_set version vector
+        # the write log is truncated up to the writes every replica has applied
+        self.replica_acks = {}
+        # seconds between anti-entropy rounds with every branch, 0 disables the background anti-entropy
+        self.sync_interval = sync_interval
+        # set to run an anti-entropy round right away, e.g. a branch is reachable again
+        self.sync_wakeup = threading.Event()
+        self.sync_stop = threading.Event()
         # write lock, make sure write operation completed before next write
-        self.lock = False
+        self.write_lock = threading.Lock()
+        # striped customer locks, serialize write_set verification and update per customer
+        self.customer_locks = [threading.Lock() for _ in range(lock_stripes)]
+        # customer conditions on the striped locks, notified when a propagated write of the customer is applied
+        self.customer_conds = [threading.Condition(lock) for lock in self.customer_locks]
+        # seconds a customer request waits for missing writes before returning error, 0 returns error immediately
+        self.session_wait = session_wait
+        # propagate completion policy, all, quorum or async(fire-and-forget)
+        self.propagate_policy = propagate_policy
+        # per-branch propagate deadline in seconds
+        self.propagate_timeout = propagate_timeout
+        # max retry attempts for a failed propagate request
+        self.propagate_retries = propagate_retries
+        # failed propagate requests ordered by retry time, (retry_at, sequence, branch id, request, attempt)
+        # the sequence keeps requests with the same retry time in queue order
+        self.retry_heap = []
+        self.retry_sequence = itertools.count()
+        # background retry worker, started on the first failed propagate request
+        self.retry_worker = None
+        self.retry_cond = threading.Condition()
+        # max number of pending writes coalesced into one batch propagate request per branch, 1 disables batching
+        self.propagate_batch_size = propagate_batch_size
+        # pending propagate requests and their sender threads based on branch id, created on first use
+        self.propagate_outboxes = {}
+        self.propagate_outboxes_lock = threading.Lock()
+        # number of propagate requests in flight or waiting for retry, notified when it drops
+        self.propagate_pending = 0
+        self.propagate_cond = threading.Condition()
+        # latency histograms and counters of the branch
+        self.metrics = MetricsRegistry()
+        # transport providing get_stub(bind_address) for the branch stubs, the process channel pool if not given
+        self.transport = transport
+        # number of branches a customer is replicated to, 0 or at least the number of branches replicates to every branch
+        self.replication_factor = replication_factor
+        self.partial_replication = 0 < replication_factor < len(branches)
+        # consistent hash ring of the branches, picks the replica group of each customer
+        self.ring = HashRing(branches)
+        # replica group based on customer id, cached ring lookups
+        self.replica_groups = {}
+        # customer balance based on customer id in partial replication, every account starts with the initial branch balance
+        self.accounts = {}
+        # number of requests processed at once, the other admitted requests wait in their lane, 0 disables admission
+        self.worker_slots = worker_slots
+        # admission lanes, max requests waiting for a worker slot based on source type, 0 is unbounded
+        # propagation gets its own lane with priority and a reserved slot, so saturated customer traffic cannot
+        # starve the writes of other branches
+        self.lane_limits = {"customer": customer_admission_limit, "branch": branch_admission_limit}
+        self.lane_waiting = {"customer": 0, "branch": 0}
+        self.lane_running = {"customer": 0, "branch": 0}
+        # moving average of the request seconds based on lane, used for the retry-after hint
+        self.lane_service_seconds = {"customer": 0.0, "branch": 0.0}
+        self.admission_cond = threading.Condition()
+        # responses based on customer request id, a retried request gets the response of the first one
+        self.dedup_cache = DedupCache(dedup_size, dedup_ttl)
+        # directory of the branch WAL and snapshot, the branch keeps its state only in memory if not given
+        self.data_dir = data_dir
+        # seconds the WAL flusher gathers writes into one fsync
+        self.wal_sync_interval = wal_sync_interval
+        # write-ahead log, opened by Open_storage
+        self.wal = None
+        # number of writes between snapshots, bounds the WAL replayed on restart
+        self.snapshot_interval = snapshot_interval
+        self.writes_since_snapshot = 0
+        self.snapshot_stop = threading.Event()
+        self.snapshot_thread = None
+        # directory of the operation logs read by the offline checker, no operation log if not given
+        self.op_log_dir = op_log_dir
+        # operation log, opened by Open_storage
+        self.op_log = None
 
     # TODO: students are expected to process requests from both Client and Branch
     def MsgDelivery(self, request, context):
+        lane = get_source_type_name(request.source_type)
+        retry_after_ms = self.Admit(lane, context)
+        if retry_after_ms:
+            return self.Response(bank_pb2.Result.busy, 0, retry_after_ms=retry_after_ms)
+        start_time = time.perf_counter()
+        try:
+            return self.Deliver_request(request, context)
+        finally:
+            self.Release(lane, time.perf_counter() - start_time)
+
+    def Deliver_request(self, request, context):
+        """
+        Process the admitted request and record its metrics
+        """
+        start_time = time.perf_counter()
+        self.events.append(request)
+        operation_name = get_operation_name(request.operation_type)
+        source_type = get_source_type_name(request.source_type)
+        self.metrics.histogram("request_bytes", SIZE_BUCKETS, source=source_type).observe(request.ByteSize())
+        #encoded size of the write_set map alone, the part of the request growing with the number of branches
+        write_set_bytes = bank_pb2.MsgDelivery_request(write_set=request.write_set).ByteSize()
+        self.metrics.histogram("write_set_bytes", SIZE_BUCKETS, source=source_type).observe(write_set_bytes)
+        try:
+            response = self.Process_idempotent(request, context)
+        except Exception:
+            self.metrics.counter("request_exceptions_total", operation=operation_name, source=source_type).inc()
+            raise
+        self.metrics.counter(
+            "requests_total",
+            operation=operation_name,
+            source=source_type,
+            result=get_result_name(response.operation_result)
+        ).inc()
+        self.metrics.histogram("request_seconds", operation=operation_name, source=source_type).observe(time.perf_counter() - start_time)
+        return response
+
+    def Process_idempotent(self, request, context):
+        """
+        Process the customer request once per request id, a retried request gets the response of the first one
+        A retry arriving while the first request is still processing waits for its response. If the retry deadline
+        runs out first the outcome is not known yet, the call fails with DEADLINE_EXCEEDED like the first one, so the
+        customer resends the same request id instead of taking the request as rejected.
+        Error responses are not cached, so a retry is processed again, e.g. once the missing writes arrived.
+        """
+        if not request.request_id or request.source_type != bank_pb2.Source.customer:
+            return self.Process_request(request, context)
+        future, owner = self.dedup_cache.begin(request.request_id)
+        if not owner:
+            self.metrics.counter("dedup_hits_total").inc()
+            try:
+                return future.result(get_time_remaining(context))
+            except futures.TimeoutError:
+                self.metrics.counter("dedup_wait_timeouts_total").inc()
+                context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, "request {} is still processing".format(request.request_id))
+        try:
+            response = self.Process_request(request, context)
+        except Exception as e:
+            self.dedup_cache.abort(request.request_id, future, exception=e)
+            raise
+        if response.operation_result in (bank_pb2.Result.error, bank_pb2.Result.busy):
+            self.dedup_cache.abort(request.request_id, future, response=response)
+        else:
+            self.dedup_cache.complete(request.request_id, future, response)
+        return response
+
+    def Process_request(self, request, context):
+        """
+        Process the request from customer or branch
+        """
+        if request.source_type == bank_pb2.Source.customer and self.id not in self.Replica_group(request.id):
+            #this branch does not hold the customer, partial replication forwards it to a replica
+            return self.Forward_request(request, context)
         new_balance = 0
         op_result = bank_pb2.Result.failure
         operation_name = get_operation_name(request.operation_type)
         source_type = get_source_type_name(request.source_type)
+        write_id = self.write_id
+        write_set = {}
+        #customer lock serializes the requests of the same customer, different customers run concurrently
+        customer_lock = timed_lock(self.Customer_lock(request.id), self.metrics.histogram("customer_lock_wait_seconds"))
         if request.operation_type == bank_pb2.Operation.query:
-            #if customer request is first time request, create empty write_set for customer
-            self.is_customer_first_operation(request)
-            logger.info("Branch {} has received customer {} {} request, verifying the write_set....".format(self.id, request.id, operation_name))
-            #Customer sent complete write_set, branch verify the write_set received if it is equal to local write_set
-            if not self.check_write_set(request):
-                op_result = bank_pb2.Result.error
-                return self.Response(op_result, new_balance)
-            new_balance = self.balance
-            op_result = bank_pb2.Result.success
+            logger.info("Branch %s has received customer %s %s request, verifying the write_set....", self.id, request.id, operation_name)
+            #query does not take the write lock, it only waits for writes of the same customer
+            with customer_lock:
+                #if customer request is first time request, create empty write_set for customer
+                self.is_customer_first_operation(request)
+                #Customer sent its write_set version vector, branch verify it has received all of the customer writes
+                if not self.Wait_write_set(request, context):
+                    op_result = bank_pb2.Result.error
+                    return self.Response(op_result, new_balance)
+                if self.op_log is None:
+                    new_balance = self.Account_balance(request.id)
+                else:
+                    #the balance is read and logged under the write lock, so the op log orders the query among the writes
+                    with self.write_lock:
+                        new_balance = self.Account_balance(request.id)
+                        self.Record_query_operation(request, new_balance)
+                op_result = bank_pb2.Result.success
+                write_set = dict(self.write_set[request.id])
         #if request from customer, run propagate
         elif request.source_type == bank_pb2.Source.customer:
-            logger.info("Branch {} has received customer {} {} request, verifying the write_set....".format(self.id, request.id, operation_name))
-            #if customer request is first time request, create empty write_set for customer
-            self.is_customer_first_operation(request)
-            #Customer sent complete write_set, branch verify the write_set received is equal to local write_set
-            if not self.check_write_set(request):
-                op_result = bank_pb2.Result.error
-                return self.Response(op_result, new_balance)
-            if request.operation_type == bank_pb2.Operation.withdraw:
-                op_result, new_balance = self.WithDraw(request.amount)
-            if request.operation_type == bank_pb2.Operation.deposit:
-                op_result, new_balance = self.Deposit(request.amount)
-            if op_result == bank_pb2.Result.success:
+            logger.info("Branch %s has received customer %s %s request, verifying the write_set....", self.id, request.id, operation_name)
+            with customer_lock:
                 #if customer request is first time request, create empty write_set for customer
-                if request.last_write_branch == 0 and request.last_write_id == 0:
-                    self.write_set[request.id] = []
-                self.write_id += 1
-                self.write_set[request.id].append({"pid":self.id, "wid": self.write_id})
-                self.Branch_Propagate(request.id, request.operation_type, request.amount)
-            
+                self.is_customer_first_operation(request)
+                #Customer sent its write_set version vector, branch verify it has received all of the customer writes
+                if not self.Wait_write_set(request, context):
+                    op_result = bank_pb2.Result.error
+                    return self.Response(op_result, new_balance)
+                #This is part of monotonic-write consistency implementation
+                #the write lock makes sure the balance update and the write_id assignment are done as one operation
+                with timed_lock(self.write_lock, self.metrics.histogram("write_lock_wait_seconds")):
+                    if request.operation_type == bank_pb2.Operation.withdraw:
+                        op_result, new_balance = self.WithDraw(request.amount, request.id)
+                    if request.operation_type == bank_pb2.Operation.deposit:
+                        op_result, new_balance = self.Deposit(request.amount, request.id)
+                    if op_result == bank_pb2.Result.success:
+                        self.write_id += 1
+                        #count the write in the customer version vector, the vector is sent to other branches as dependency
+                        customer_write_set = self.write_set[request.id]
+                        customer_write_set[self.id] = customer_write_set.get(self.id, 0) + 1
+                        propagate_request = self.Create_propagate_request(
+                            request.id,
+                            request.operation_type,
+                            request.amount,
+                            self.write_id,
+                            customer_write_set
+                        )
+                        #WAL records are appended in balance update order, so replay gives the same balance
+                        self.Append_wal(propagate_request)
+                        self.Record_write_operation(propagate_request, op_result, get_request_seq(request.request_id))
+                    write_id = self.write_id
+                if op_result == bank_pb2.Result.success:
+                    self.Log_write(propagate_request)
+                write_set = dict(self.write_set[request.id])
+            if op_result == bank_pb2.Result.success:
+                #the write must be durable before anyone learns about it
+                self.Wait_wal()
+                #propagate runs without holding any lock, so the branch keeps serving other requests meanwhile
+                self.Branch_Propagate(propagate_request)
+
         #if request from branch, no progagate
         elif request.source_type == bank_pb2.Source.branch:
-            logger.info("Branch {} has received branch {} propagate request...".format(self.id, request.last_write_branch))
-            if request.operation_type == bank_pb2.Operation.withdraw:
-                op_result, new_balance = self.WithDraw(request.amount)
-            elif request.operation_type == bank_pb2.Operation.deposit:
-                op_result, new_balance = self.Deposit(request.amount)
-            #update local self.write_id from propagate request
-            self.write_id = request.last_write_id
-            #if write_set does not have key for customer, that means customer first write, so create empty list for new customer
-            self.is_customer_first_operation(request)
-            #update the write_set from propagate request
-            self.write_set[request.id].append({"pid":request.last_write_branch, "wid":request.last_write_id})
+            logger.info("Branch %s has received branch %s propagate request...", self.id, request.last_write_branch)
+            with customer_lock:
+                #if write_set does not have key for customer, that means customer first write, so create empty write_set for new customer
+                self.is_customer_first_operation(request)
+                if self.is_write_applied(request):
+                    #duplicated propagate request, the write is already applied
+                    op_result = bank_pb2.Result.success
+                elif not self.is_write_ready(request):
+                    #propagate requests may arrive out of order, hold the write until its dependencies are applied
+                    logger.info(
+                        "Branch %s holds the write of customer %s from branch %s, waiting for dependencies",
+                        self.id,
+                        request.id,
+                        request.last_write_branch
+                    )
+                    self.pending_writes.setdefault(request.id, []).append(request)
+                    op_result = bank_pb2.Result.success
+                else:
+                    op_result, new_balance, write_id = self.Apply_propagate(request)
+                    self.Apply_pending_writes(request.id)
+                #the customer write_set tells the origin branch which writes are applied here
+                write_set = dict(self.write_set[request.id])
+            #acknowledge the propagated writes only once they are durable
+            self.Wait_wal()
         #customer response or propagate response
-        response = self.Response(op_result, new_balance)
-        logger.info("Branch {} operation result {}, amount {}, clock {}, last_write_id {}".format(
-            self.id, 
-            get_result_name(op_result), 
-            new_balance, 
-            self.clock, 
-            self.write_id
-            )
+        response = self.Response(op_result, new_balance, write_id, write_set)
+        logger.info(
+            "Branch %s operation result %s, amount %s, clock %s, last_write_id %s",
+            self.id,
+            get_result_name(op_result),
+            new_balance,
+            self.clock,
+            write_id
         )
-        #release the lock after completed the write operation
-        self.lock = False
         #response customer or branch propagate
         return response
     
-    def Response(self, op_result, new_balance):
+    def MsgDeliveryBatch(self, request, context):
+        """
+        Process the batched requests one by one in order, so per-operation order and session guarantees are the same as MsgDelivery
+        The batch is admitted as a whole, every request gets the busy response if the lane is saturated
+        """
+        if not request.requests:
+            return bank_pb2.MsgDelivery_batch_response()
+        lane = get_source_type_name(request.requests[0].source_type)
+        retry_after_ms = self.Admit(lane, context)
+        if retry_after_ms:
+            busy = self.Response(bank_pb2.Result.busy, 0, retry_after_ms=retry_after_ms)
+            return bank_pb2.MsgDelivery_batch_response(responses = [busy] * len(request.requests))
+        start_time = time.perf_counter()
+        try:
+            responses = [self.Deliver_request(item, context) for item in request.requests]
+        finally:
+            self.Release(lane, time.perf_counter() - start_time)
+        return bank_pb2.MsgDelivery_batch_response(responses = responses)
+
+    def Admission_queue_capacity(self):
+        """
+        Number of requests the lanes hold waiting for a worker slot, the gRPC server needs a thread for each of
+        them on top of the worker slots. An unbounded lane is given worker_slots threads to wait on.
+        """
+        if not self.worker_slots:
+            return 0
+        return sum(limit or self.worker_slots for limit in self.lane_limits.values())
+
+    def Lane_can_run(self, lane):
+        """
+        Whether a request of the lane can take a worker slot now, called with the admission condition held
+        Propagate requests go first, customer requests leave one slot to them so propagation never waits behind
+        customer requests that wait for the propagated writes.
+        """
+        if sum(self.lane_running.values()) >= self.worker_slots:
+            return False
+        if lane == "branch":
+            return True
+        return not self.lane_waiting["branch"] and self.lane_running["customer"] < max(self.worker_slots - 1, 1)
+
+    def Admit(self, lane, context=None):
+        """
+        Take a worker slot for a request of the lane, return 0 if admitted
+        If no slot is free the request waits in the lane until one is released or its deadline expires. A full lane
+        rejects the request right away, the return value is then the retry-after hint in milliseconds, the time
+        the requests queued ahead of it are expected to take.
+        """
+        if not self.worker_slots:
+            return 0
+        limit = self.lane_limits[lane]
+        with self.admission_cond:
+            waiting = self.lane_waiting[lane]
+            admitted = not waiting and self.Lane_can_run(lane)
+            if not admitted and (not limit or waiting < limit):
+                self.lane_waiting[lane] += 1
+                try:
+                    admitted = self.admission_cond.wait_for(
+                        lambda: self.Lane_can_run(lane), get_time_remaining(context)
+                    )
+                finally:
+                    self.lane_waiting[lane] -= 1
+            if admitted:
+                self.lane_running[lane] += 1
+            else:
+                #the branch lane waiters are served before the customer ones
+                ahead = self.lane_waiting[lane] + (self.lane_waiting["branch"] if lane == "customer" else 0) + 1
+                retry_after_ms = max(int(1000 * self.lane_service_seconds[lane] * ahead / self.worker_slots), 1)
+        self.metrics.histogram("admission_waiting", SIZE_BUCKETS, lane=lane).observe(waiting)
+        if admitted:
+            return 0
+        self.metrics.counter("admission_rejections_total", lane=lane).inc()
+        return retry_after_ms
+
+    def Release(self, lane, seconds):
+        """
+        Release the worker slot of an admitted request, wake up the waiting requests and update the moving average
+        of the request seconds
+        """
+        with self.admission_cond:
+            self.lane_service_seconds[lane] += 0.2 * (seconds - self.lane_service_seconds[lane])
+            if self.worker_slots:
+                self.lane_running[lane] -= 1
+                self.admission_cond.notify_all()
+
+    def Replica_group(self, customer_id):
+        """
+        Branch ids the customer is replicated to, chosen by consistent hashing on the customer id
+        """
+        if not self.partial_replication:
+            return self.branches
+        group = self.replica_groups.get(customer_id)
+        if group is None:
+            group = self.replica_groups.setdefault(customer_id, self.ring.get_nodes(customer_id, self.replication_factor))
+        return group
+
+    def Forward_request(self, request, context=None):
+        """
+        Forward the customer request to a branch of its replica group within the customer deadline
+        Replicas are tried in ring order. A write fails over only if the replica is unavailable, a write that timed
+        out may be applied already, so it returns error and the customer retry with the same request id goes back
+        to the first replica and its dedup cache. Return error if no replica is reachable.
+        """
+        for branch_id in self.Replica_group(request.id):
+            stub = self.Get_transport().get_stub(self.branches_bind_addresses[branch_id])
+            try:
+                response = stub.MsgDelivery(request, timeout=get_time_remaining(context))
+            except grpc.RpcError as e:
+                logger.info("Branch %s forward to branch %s failed with %s", self.id, branch_id, e.code())
+                if request.operation_type != bank_pb2.Operation.query and e.code() != grpc.StatusCode.UNAVAILABLE:
+                    self.metrics.counter("forward_failures_total").inc()
+                    return self.Response(bank_pb2.Result.error, 0)
+                continue
+            self.metrics.counter("forwarded_requests_total", branch=branch_id).inc()
+            return response
+        self.metrics.counter("forward_failures_total").inc()
+        return self.Response(bank_pb2.Result.error, 0)
+
+    def Response(self, op_result, new_balance, write_id=None, write_set=None, retry_after_ms=0):
         """
         Can be used for customer response or branch propagate response
+        write_id is the write_id of the operation, current write_id is used if not given
+        write_set is the branch write_set version vector of the customer
+        retry_after_ms is the backoff hint of a busy response
         """
+        if write_id is None:
+            write_id = self.write_id
         response = bank_pb2.MsgDelivery_response(
             operation_result = op_result,
             source_type = bank_pb2.Source.branch,
             id = self.id,
             amount = new_balance,
             clock = self.clock,
-            last_write_id = self.write_id
+            last_write_id = write_id,
+            write_set = write_set,
+            retry_after_ms = retry_after_ms
         )
         return response
 
+    def Customer_lock(self, customer_id):
+        """
+        Striped lock of the customer, requests of the same customer are serialized
+        """
+        return self.customer_locks[customer_id % len(self.customer_locks)]
+
+    def Customer_condition(self, customer_id):
+        """
+        Condition of the customer striped lock
+        """
+        return self.customer_conds[customer_id % len(self.customer_conds)]
+
     def is_customer_first_operation(self, request):
         """
         Check if customer is first operation, if it's create an empty write_set for customer.
         """
         if request.id not in self.write_set:
-                self.write_set[request.id] = []
+                self.write_set[request.id] = {}
 
     def check_write_set(self, request):
         """
-        Compare the write_set from customer and local write_set, if different, return False, otherwise return Ture.
+        Compare the write_set version vector from customer with local write_set.
+        Return True if local write_set has every customer write, otherwise return False.
+        Cost is bounded by the number of branches instead of the customer history.
         """
-        if json.loads(request.write_set) != self.write_set[request.id]:
-            logger.info("Branch write_set verify failed, customer write_set {} != branch write_set {}".format(
-                request.write_set, 
-                self.write_set[request.id]
+        start_time = time.perf_counter()
+        local_write_set = self.write_set[request.id]
+        missing = self.Missing_writes(request)
+        self.metrics.histogram("write_set_verify_seconds").observe(time.perf_counter() - start_time)
+        if missing:
+            logger.info("Branch %s write_set verify failed, customer %s writes %s not received yet", self.id, request.id, missing)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Branch write_set verify failed, customer write_set %s is ahead of branch write_set %s",
+                    dict(request.write_set),
+                    dict(local_write_set)
                 )
-            )
             return False
-        logger.info("Branch write_set verify succeed..customer write_set {} == local write_set {}".format(
-            request.write_set,
-            self.write_set[request.id]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Branch write_set verify succeed..customer write_set %s covered by local write_set %s",
+                dict(request.write_set),
+                dict(local_write_set)
             )
-        )
         return True
 
-    def Deposit(self, amount):
+    def Missing_writes(self, request):
+        """
+        Customer writes not received yet, branch id -> number of customer writes from the branch
+        Only the writes of the customer replica group are checked, other branches never receive them
+        """
+        local_write_set = self.write_set[request.id]
+        replica_group = self.Replica_group(request.id)
+        return {
+            branch: count for branch, count in request.write_set.items()
+            if branch in replica_group and local_write_set.get(branch, 0) < count
+        }
+
+    def Wait_write_set(self, request, context):
+        """
+        Verify the customer write_set, caller must hold the customer lock
+        If writes are missing and session_wait is set, park the request on the customer condition until the
+        propagated writes arrive, the session_wait deadline or the RPC deadline expires.
+        """
+        if self.check_write_set(request):
+            return True
+        timeout = self.session_wait
+        if context is not None and context.time_remaining() is not None:
+            timeout = min(timeout, context.time_remaining())
+        if timeout <= 0:
+            return False
+        start_time = time.perf_counter()
+        succeed = self.Customer_condition(request.id).wait_for(lambda: not self.Missing_writes(request), timeout)
+        self.metrics.histogram("session_wait_seconds").observe(time.perf_counter() - start_time)
+        if not succeed:
+            self.metrics.counter("session_wait_timeouts_total").inc()
+            logger.info("Branch %s gave up waiting for customer %s writes after %.3fs", self.id, request.id, timeout)
+        return succeed
+
+    def is_write_applied(self, request):
+        """
+        Check if the propagated write is already applied, the write_set of propagate request counts the write itself
+        """
+        origin = request.last_write_branch
+        return request.write_set[origin] <= self.write_set[request.id].get(origin, 0)
+
+    def is_write_ready(self, request):
+        """
+        Check if the propagated write can be applied, it must be the next write from the origin branch
+        and all of the customer writes it depends on from other branches must be applied already.
+        The merged truncated writes of a Sync state transfer do not wait for their dependencies, every replica has
+        applied them already and the merged writes of the other origins may depend on them in turn.
+        """
+        origin = request.last_write_branch
+        local_write_set = self.write_set[request.id]
+        if request.write_count:
+            return request.write_set[origin] == local_write_set.get(origin, 0) + request.write_count
+        for branch, count in request.write_set.items():
+            if branch == origin:
+                if count != local_write_set.get(branch, 0) + 1:
+                    return False
+            elif local_write_set.get(branch, 0) < count:
+                return False
+        return True
+
+    def Apply_propagate(self, request):
+        """
+        Apply the propagated write to the balance and merge its write_set, caller must hold the customer lock
+        """
+        op_result = bank_pb2.Result.failure
+        new_balance = 0
+        with timed_lock(self.write_lock, self.metrics.histogram("write_lock_wait_seconds")):
+            if request.operation_type == bank_pb2.Operation.withdraw:
+                op_result, new_balance = self.WithDraw(request.amount, request.id)
+            elif request.operation_type == bank_pb2.Operation.deposit:
+                op_result, new_balance = self.Deposit(request.amount, request.id)
+            #update local self.write_id from propagate request, propagate requests may arrive out of order
+            self.write_id = max(self.write_id, request.last_write_id)
+            write_id = self.write_id
+            self.Append_wal(request)
+            self.Record_write_operation(request, op_result)
+        local_write_set = self.write_set[request.id]
+        if request.write_count:
+            #merged truncated writes count only the writes of their origin
+            local_write_set[request.last_write_branch] = request.write_set[request.last_write_branch]
+        else:
+            for branch, count in request.write_set.items():
+                if count > local_write_set.get(branch, 0):
+                    local_write_set[branch] = count
+        self.Log_write(request)
+        #wake up the customer requests waiting for this write
+        self.Customer_condition(request.id).notify_all()
+        return op_result, new_balance, write_id
+
+    def Apply_pending_writes(self, customer_id):
+        """
+        Apply the held propagated writes of the customer which dependencies are satisfied now
+        """
+        pending = self.pending_writes.get(customer_id)
+        while pending:
+            ready = [request for request in pending if self.is_write_applied(request) or self.is_write_ready(request)]
+            if not ready:
+                break
+            for request in ready:
+                pending.remove(request)
+                if not self.is_write_applied(request):
+                    self.Apply_propagate(request)
+        if customer_id in self.pending_writes and not pending:
+            del self.pending_writes[customer_id]
+
+    def Deposit(self, amount, customer_id=None):
         if amount < 0:
             return bank_pb2.Result.error, amount
-        #This is part of monotonic-write consistency implementation
-        #if self.lock == True, which is indicated process doing write operation, have to wait
-        while self.lock:
-            time.sleep(1)
-        self.balance += amount
-        return bank_pb2.Result.success, self.balance
-
-    def WithDraw(self, amount):
-        if amount > self.balance:
+        #caller must hold self.write_lock
+        balance = self.Account_balance(customer_id) + amount
+        self.Update_balance(customer_id, balance)
+        return bank_pb2.Result.success, balance
+
+    def WithDraw(self, amount, customer_id=None):
+        balance = self.Account_balance(customer_id)
+        if amount > balance:
             return bank_pb2.Result.failure, amount
-        #This is part of monotonic-write consistency implementation
-        #if self.lock == True, which is indicated process doing write operation, have to wait
-        while self.lock:
-            time.sleep(1)
-        self.balance -= amount
-        return bank_pb2.Result.success, self.balance
+        #caller must hold self.write_lock
+        balance -= amount
+        self.Update_balance(customer_id, balance)
+        return bank_pb2.Result.success, balance
+
+    def Account_balance(self, customer_id):
+        """
+        Balance of the customer, every customer shares the branch balance unless partial replication is enabled
+        """
+        if self.partial_replication:
+            return self.accounts.get(customer_id, self.balance)
+        return self.balance
+
+    def Update_balance(self, customer_id, balance):
+        if self.partial_replication:
+            self.accounts[customer_id] = balance
+        else:
+            self.balance = balance
     
-    def Create_propagate_request(self, customer_id, operation_type, amount):
+    def Create_propagate_request(self, customer_id, operation_type, amount, write_id, write_set):
         """
         Build the branch propagate request context
         """
@@ -167,36 +649,579 @@ class Branch(bank_pb2_grpc.BankServicer):
             id = customer_id,
             amount = amount,
             clock = self.clock,
-            last_write_id = self.write_id,
+            last_write_id = write_id,
             last_write_branch = self.id,
-            write_set = ""
+            write_set = write_set
         )
         return request
 
-    def Create_branches_stub(self):
+    def Get_transport(self):
+        """
+        Transport of the branch stubs, e.g. the in-process simulated network, defaults to the process channel pool
+        """
+        if self.transport is not None:
+            return self.transport
+        return get_channel_pool(len(self.branches))
+
+    def Create_branches_stub(self, customer_id=None):
         """
-        Create branches stub
+        Create branches stub, keyed by branch id
+        Stubs come from the process channel pool, so one long-lived channel per branch is shared by all requests
+        Only the replica group of the customer is included if customer_id is given
         """
-        for branch in self.branches:
+        transport = self.Get_transport()
+        stubs = {}
+        branches = self.branches if customer_id is None else self.Replica_group(customer_id)
+        for branch in branches:
             if branch != self.id:
-                bind_address = self.branches_bind_addresses[branch]
-                stub = bank_pb2_grpc.BankStub(grpc.insecure_channel(bind_address))
-                self.stubList.append(stub)
+                stubs[branch] = transport.get_stub(self.branches_bind_addresses[branch])
+        return stubs
 
-    def Branch_Propagate(self, customer_id, operation_type, amount):
+    def Propagate_required_acks(self, stubs):
+        """
+        Number of branches propagate success required before return to customer
+        all: every other replica, quorum: majority of the replicas (local branch counts as one), async: none
+        """
+        if self.propagate_policy == "quorum":
+            return (len(stubs) + 1) // 2
+        if self.propagate_policy == "async":
+            return 0
+        return len(stubs)
+
+    def Branch_Propagate(self, propagate_request):
         """
         Run branches propagate
-        If all of branches propagate return success, return list of branches propagate response clock
-        """
-        operation_name = get_operation_name(operation_type)
-        if len(self.stubList) == 0:
-            self.Create_branches_stub()
-        logger.info("Branch {} start propagating ...".format(self.id))
-        for stub in self.stubList:
-            propagate_request = self.Create_propagate_request(customer_id, operation_type, amount)
-            response = stub.MsgDelivery(propagate_request)
-            logger.info("Propagate response {} from branch {}".format(
-                get_result_name(response.operation_result), 
+        Propagate request is sent to all of branches at once, then wait until the propagate policy is satisfied
+        or every branch has responded. Failed propagate requests are handed over to the background retry worker.
+        """
+        stubs = self.Create_branches_stub(propagate_request.id)
+        logger.info("Branch %s start propagating with policy %s ...", self.id, self.propagate_policy)
+        completed = queue.Queue()
+        start_time = time.perf_counter()
+        self.Update_propagate_pending(len(stubs))
+        for branch_id, stub in stubs.items():
+            if self.propagate_batch_size > 1:
+                future = self.Queue_propagate_batch(branch_id, propagate_request)
+            else:
+                future = stub.MsgDelivery.future(propagate_request, timeout=self.propagate_timeout)
+            future.add_done_callback(
+                lambda future, branch_id=branch_id: self.Propagate_done(branch_id, propagate_request, future, completed, start_time)
+            )
+        required_acks = self.Propagate_required_acks(stubs)
+        acks = 0
+        for _ in range(len(stubs)):
+            if acks >= required_acks:
+                break
+            if completed.get():
+                acks += 1
+        if acks < required_acks:
+            logger.info(
+                "Branch %s propagate policy %s not satisfied, %s/%s branches acknowledged",
+                self.id,
+                self.propagate_policy,
+                acks,
+                required_acks
+            )
+
+    def Queue_propagate_batch(self, branch_id, propagate_request):
+        """
+        Queue the propagate request to the branch outbox, return a future of its response
+        One sender thread per branch coalesces the queued requests into batch requests
+        """
+        with self.propagate_outboxes_lock:
+            if branch_id not in self.propagate_outboxes:
+                outbox = queue.Queue()
+                sender = threading.Thread(
+                    target=self.Propagate_sender,
+                    args=(branch_id, outbox),
+                    name="Branch-{}-propagate-to-{}".format(self.id, branch_id),
+                    daemon=True
+                )
+                self.propagate_outboxes[branch_id] = outbox
+                sender.start()
+            outbox = self.propagate_outboxes[branch_id]
+        future = futures.Future()
+        outbox.put((propagate_request, future))
+        return future
+
+    def Propagate_sender(self, branch_id, outbox):
+        """
+        Send the queued propagate requests to the branch, requests queued while a batch is in flight go in the next batch
+        """
+        while True:
+            batch = [outbox.get()]
+            while len(batch) < self.propagate_batch_size:
+                try:
+                    batch.append(outbox.get_nowait())
+                except queue.Empty:
+                    break
+            batch_request = bank_pb2.MsgDelivery_batch_request(requests = [request for request, _ in batch])
+            stub = self.Get_transport().get_stub(self.branches_bind_addresses[branch_id])
+            try:
+                batch_response = stub.MsgDeliveryBatch(batch_request, timeout=self.propagate_timeout)
+            except grpc.RpcError as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), response in zip(batch, batch_response.responses):
+                future.set_result(response)
+
+    def Propagate_done(self, branch_id, propagate_request, future, completed, start_time):
+        """
+        Propagate response callback, runs once the branch responded or the deadline expired
+        """
+        succeed = False
+        try:
+            response = future.result()
+            succeed = response.operation_result == bank_pb2.Result.success
+            self.metrics.histogram("propagate_rtt_seconds", branch=branch_id).observe(time.perf_counter() - start_time)
+            logger.info(
+                "Propagate response %s from branch %s",
+                get_result_name(response.operation_result),
                 response.id
+            )
+            if response.operation_result == bank_pb2.Result.busy:
+                #the branch rejected the write under load, back off and resend it
+                self.Queue_propagate_retry(branch_id, propagate_request, 1)
+            else:
+                self.Record_ack(branch_id, propagate_request.id, response.write_set)
+        except grpc.RpcError as e:
+            self.metrics.counter("propagate_failures_total", branch=branch_id).inc()
+            logger.info("Propagate to branch %s failed with %s, queued for retry", branch_id, e.code())
+            self.Queue_propagate_retry(branch_id, propagate_request, 1)
+        self.Update_propagate_pending(-1)
+        completed.put(succeed)
+
+    def Update_propagate_pending(self, delta):
+        """
+        Count propagate requests in flight or waiting for retry, wake up Drain_propagate when none left
+        """
+        with self.propagate_cond:
+            self.propagate_pending += delta
+            if self.propagate_pending == 0:
+                self.propagate_cond.notify_all()
+
+    def Drain_propagate(self, timeout):
+        """
+        Wait until every propagate request is acknowledged or given up, return False if timeout expired first
+        """
+        with self.propagate_cond:
+            return self.propagate_cond.wait_for(lambda: self.propagate_pending == 0, timeout)
+
+    def Queue_propagate_retry(self, branch_id, propagate_request, attempt):
+        """
+        Queue a failed propagate request for the background retry worker, start the worker if not running yet
+        """
+        #exponential backoff, 0.1s, 0.2s, 0.4s ...
+        retry_at = time.monotonic() + 0.1 * 2 ** (attempt - 1)
+        self.Update_propagate_pending(1)
+        with self.retry_cond:
+            if self.retry_worker is None:
+                self.retry_worker = threading.Thread(
+                    target=self.Retry_propagate,
+                    name="Branch-{}-propagate-retry".format(self.id),
+                    daemon=True
                 )
+                self.retry_worker.start()
+            heapq.heappush(self.retry_heap, (retry_at, next(self.retry_sequence), branch_id, propagate_request, attempt))
+            self.retry_cond.notify()
+
+    def Retry_propagate(self):
+        """
+        Background retry worker, resend failed propagate requests in retry time order until succeed or run out of attempts
+        Resends are asynchronous, so a slow or dead branch does not hold up the retries to the other branches.
+        """
+        while True:
+            with self.retry_cond:
+                while not self.retry_heap or self.retry_heap[0][0] > time.monotonic():
+                    self.retry_cond.wait(self.retry_heap[0][0] - time.monotonic() if self.retry_heap else None)
+                _, _, branch_id, propagate_request, attempt = heapq.heappop(self.retry_heap)
+            self.metrics.counter("propagate_retries_total", branch=branch_id).inc()
+            try:
+                stub = self.Get_transport().get_stub(self.branches_bind_addresses[branch_id])
+                future = stub.MsgDelivery.future(propagate_request, timeout=self.propagate_timeout)
+            except grpc.RpcError as e:
+                self.Retry_propagate_failed(branch_id, propagate_request, attempt, e.code())
+                continue
+            future.add_done_callback(
+                lambda future, branch_id=branch_id, propagate_request=propagate_request, attempt=attempt:
+                    self.Retry_propagate_done(branch_id, propagate_request, attempt, future)
             )
+
+    def Retry_propagate_done(self, branch_id, propagate_request, attempt, future):
+        """
+        Propagate retry response callback, queue the next attempt if the branch failed again
+        """
+        try:
+            response = future.result()
+        except grpc.RpcError as e:
+            self.Retry_propagate_failed(branch_id, propagate_request, attempt, e.code())
+            return
+        logger.info(
+            "Propagate retry %s response %s from branch %s",
+            attempt,
+            get_result_name(response.operation_result),
+            response.id
+        )
+        if response.operation_result == bank_pb2.Result.busy:
+            self.Retry_propagate_failed(branch_id, propagate_request, attempt, "busy")
+            return
+        self.Record_ack(branch_id, propagate_request.id, response.write_set)
+        #the branch is reachable again, run anti-entropy so it catches up with anything else it missed
+        self.sync_wakeup.set()
+        self.Update_propagate_pending(-1)
+
+    def Retry_propagate_failed(self, branch_id, propagate_request, attempt, failure):
+        if attempt >= self.propagate_retries:
+            self.metrics.counter("propagate_dropped_total", branch=branch_id).inc()
+            logger.info(
+                "Propagate to branch %s failed with %s, giving up after %s retries",
+                branch_id,
+                failure,
+                attempt
+            )
+        else:
+            self.Queue_propagate_retry(branch_id, propagate_request, attempt + 1)
+        self.Update_propagate_pending(-1)
+
+    def Append_wal(self, request):
+        """
+        Append the applied write to the WAL, caller must hold the write lock
+        """
+        if self.wal is None:
+            return
+        self.wal.append(request.SerializeToString())
+        self.writes_since_snapshot += 1
+        self.metrics.counter("wal_records_total").inc()
+
+    def Wait_wal(self):
+        """
+        Wait until every write appended to the WAL so far is durable, shares the fsync with concurrent writes
+        """
+        if self.wal is None:
+            return
+        start_time = time.perf_counter()
+        self.wal.wait()
+        self.metrics.histogram("wal_wait_seconds").observe(time.perf_counter() - start_time)
+
+    def Storage_directory(self):
+        return os.path.join(self.data_dir, "branch_{}".format(self.id))
+
+    def Open_storage(self):
+        """
+        Recover the branch state from the snapshot and the WAL tail in data_dir, then start logging the writes
+        A branch without a snapshot or WAL starts from the input balance.
+        The operation log is opened after the recovery, so it starts from the recovered balance.
+        Must be called in the process serving the branch, before it serves any request.
+        """
+        if self.data_dir is None:
+            self.Open_op_log()
+            return
+        start_time = time.perf_counter()
+        directory = self.Storage_directory()
+        os.makedirs(directory, exist_ok=True)
+        snapshot = load_snapshot(directory)
+        first_segment = 0
+        if snapshot is not None:
+            self.Restore_snapshot(snapshot)
+            first_segment = snapshot["segment"]
+        replayed = 0
+        for payload in read_segments(directory, first_segment):
+            request = bank_pb2.MsgDelivery_request.FromString(payload)
+            with self.Customer_lock(request.id):
+                self.is_customer_first_operation(request)
+                if not self.is_write_applied(request):
+                    self.Apply_propagate(request)
+            replayed += 1
+        segments = list_segments(directory)
+        self.wal = WriteAheadLog(directory, segments[-1] + 1 if segments else 0, self.wal_sync_interval, self.metrics)
+        logger.info(
+            "Branch %s recovered balance %s from %s and %s WAL records in %.3fs",
+            self.id,
+            self.balance,
+            "snapshot of segment {}".format(first_segment) if snapshot is not None else "input",
+            replayed,
+            time.perf_counter() - start_time
+        )
+        self.snapshot_stop.clear()
+        self.snapshot_thread = threading.Thread(
+            target=self.Snapshot_service,
+            name="Branch-{}-snapshot".format(self.id),
+            daemon=True
+        )
+        self.snapshot_thread.start()
+        self.Open_op_log()
+
+    def Restore_snapshot(self, snapshot):
+        self.balance = snapshot["balance"]
+        self.write_id = snapshot["write_id"]
+        self.accounts = {int(customer_id): balance for customer_id, balance in snapshot["accounts"].items()}
+        self.write_set = {
+            int(customer_id): {int(branch): count for branch, count in write_set.items()}
+            for customer_id, write_set in snapshot["write_set"].items()
+        }
+        self.write_log = {(customer_id, origin): WriteLog.from_state(state) for customer_id, origin, state in snapshot["write_log"]}
+
+    def Snapshot(self):
+        """
+        Write a snapshot of the branch state and drop the WAL segments it covers
+        Every lock is held while the state is copied, so the snapshot is a consistent cut of the WAL.
+        """
+        start_time = time.perf_counter()
+        with contextlib.ExitStack() as stack:
+            for lock in self.customer_locks:
+                stack.enter_context(lock)
+            stack.enter_context(self.write_lock)
+            segment = self.wal.roll()
+            snapshot = {
+                "segment": segment,
+                "balance": self.balance,
+                "write_id": self.write_id,
+                "accounts": dict(self.accounts),
+                "write_set": {customer_id: dict(write_set) for customer_id, write_set in self.write_set.items()},
+                "write_log": [[customer_id, origin, log.to_state()] for (customer_id, origin), log in self.write_log.items()],
+            }
+            self.writes_since_snapshot = 0
+        directory = self.Storage_directory()
+        write_snapshot(directory, snapshot)
+        remove_segments(directory, segment)
+        self.metrics.histogram("snapshot_seconds").observe(time.perf_counter() - start_time)
+        logger.info("Branch %s wrote snapshot at WAL segment %s", self.id, segment)
+
+    def Snapshot_service(self):
+        """
+        Background snapshots, one every snapshot_interval writes
+        """
+        while not self.snapshot_stop.wait(0.5):
+            if self.snapshot_interval > 0 and self.writes_since_snapshot >= self.snapshot_interval:
+                self.Snapshot()
+
+    def Close_storage(self):
+        """
+        Stop the snapshots, write a final snapshot so the next start replays nothing, and close the WAL
+        """
+        self.Close_op_log()
+        if self.wal is None:
+            return
+        self.snapshot_stop.set()
+        self.snapshot_thread.join()
+        self.Snapshot()
+        self.wal.close()
+        self.wal = None
+
+    def Open_op_log(self):
+        if self.op_log_dir is None:
+            return
+        os.makedirs(self.op_log_dir, exist_ok=True)
+        self.op_log = OperationLog(
+            get_op_log_file_name(self.op_log_dir, self.id),
+            self.id,
+            self.balance,
+            self.replication_factor if self.partial_replication else 0
+        )
+
+    def Close_op_log(self):
+        if self.op_log is None:
+            return
+        self.op_log.close()
+        self.op_log = None
+
+    def Record_write_operation(self, request, op_result, seq=0):
+        """
+        Log the applied write of the propagate request to the operation log, caller must hold the write lock
+        seq is the customer request sequence number on the origin branch
+        """
+        if self.op_log is None:
+            return
+        self.op_log.record(
+            WRITE,
+            request.id,
+            request.last_write_branch,
+            request.write_set[request.last_write_branch],
+            sum(request.write_set.values()),
+            request.operation_type,
+            request.amount,
+            op_result,
+            self.Account_balance(request.id),
+            seq
+        )
+
+    def Record_query_operation(self, request, balance):
+        """
+        Log the successful customer query to the operation log, caller must hold the customer lock and the write lock
+        """
+        self.op_log.record(
+            QUERY,
+            request.id,
+            self.id,
+            0,
+            sum(self.write_set[request.id].values()),
+            request.operation_type,
+            0,
+            bank_pb2.Result.success,
+            balance,
+            get_request_seq(request.request_id)
+        )
+
+    def Dump_metrics(self, file_name):
+        """
+        Write the branch metrics to the json file
+        """
+        self.metrics.dump(file_name, {
+            "branch": self.id,
+            "balance": self.balance,
+            "write_id": self.write_id,
+            "propagate_pending": self.propagate_pending,
+            "memory": self.Memory_usage(),
+        })
+
+    def Memory_usage(self):
+        """
+        Size of the branch state, entries are counted instead of measured so the report stays cheap
+        """
+        write_logs = list(self.write_log.values())
+        return {
+            "write_log_records": sum(len(log) for log in write_logs),
+            "write_log_truncated": sum(log.base for log in write_logs),
+            "pending_writes": sum(len(pending) for pending in list(self.pending_writes.values())),
+            "write_set_entries": sum(len(write_set) for write_set in list(self.write_set.values())),
+            "accounts": len(self.accounts),
+            "events": len(self.events),
+            "dedup_entries": len(self.dedup_cache),
+            "process_max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        }
+
+    def Log_write(self, request):
+        """
+        Append the applied write to the write log, caller must hold the customer lock
+        The write log only serves Sync, without anti-entropy nothing reads it and no Sync summary acknowledges the
+        writes of the other origins, so it is not kept.
+        """
+        if self.sync_interval <= 0:
+            return
+        key = (request.id, request.last_write_branch)
+        if key not in self.write_log:
+            self.write_log[key] = WriteLog()
+        self.write_log[key].append(request)
+
+    def Record_ack(self, branch_id, customer_id, write_set):
+        """
+        Merge the customer writes applied by the branch, then truncate the writes every other replica has applied
+        """
+        with self.Customer_lock(customer_id):
+            acks = self.replica_acks.setdefault(customer_id, {})
+            branch_acks = acks.setdefault(branch_id, {})
+            for origin, count in write_set.items():
+                if count > branch_acks.get(origin, 0):
+                    branch_acks[origin] = count
+            replicas = [branch for branch in self.Replica_group(customer_id) if branch != self.id]
+            if any(branch not in acks for branch in replicas):
+                return
+            for origin in list(self.write_set.get(customer_id, {})):
+                log = self.write_log.get((customer_id, origin))
+                if log is None:
+                    continue
+                acked = min((acks[branch].get(origin, 0) for branch in replicas), default=log.base + len(log))
+                dropped = log.truncate(acked)
+                if dropped:
+                    self.metrics.counter("write_log_truncated_total").inc(dropped)
+
+    def Sync(self, request, context):
+        """
+        Anti-entropy, stream the logged writes the requesting branch has not received yet
+        Only the gap is sent, the cost is proportional to the missing writes instead of the whole history.
+        """
+        received = {(summary.customer, summary.branch): summary.count for summary in request.summary}
+        #the summary is what the requesting branch has applied, so it doubles as an acknowledgement
+        summaries = {}
+        for (customer_id, origin), count in received.items():
+            summaries.setdefault(customer_id, {})[origin] = count
+        for customer_id, write_set in summaries.items():
+            self.Record_ack(request.id, customer_id, write_set)
+        sent = 0
+        for (customer_id, origin), log in list(self.write_log.items()):
+            if request.id not in self.Replica_group(customer_id):
+                continue
+            count = received.get((customer_id, origin), 0)
+            merged = None
+            with self.Customer_lock(customer_id):
+                records = log.since(count)
+                if records is None and count == 0:
+                    #the branch has lost every write, e.g. restarted without its data dir, send the truncated writes merged into one
+                    merged = log.merged_request(customer_id, origin)
+                    records = log.records[:]
+            if merged is not None:
+                self.metrics.counter("sync_state_transfers_total", branch=request.id).inc()
+                sent += 1
+                yield merged
+            if records is None:
+                self.metrics.counter("sync_truncated_total", branch=request.id).inc()
+                logger.info(
+                    "Branch %s cannot serve customer %s writes from branch %s to branch %s, they are truncated",
+                    self.id,
+                    customer_id,
+                    origin,
+                    request.id
+                )
+                continue
+            for record in records:
+                sent += 1
+                yield record.to_request(customer_id, origin)
+        self.metrics.counter("sync_writes_sent_total", branch=request.id).inc(sent)
+        logger.info("Branch %s sent %s missing writes to branch %s", self.id, sent, request.id)
+
+    def Create_sync_request(self):
+        """
+        Build the anti-entropy request, summary of the writes received based on customer and origin branch
+        """
+        summary = []
+        for customer_id, write_set in list(self.write_set.items()):
+            for origin, count in list(write_set.items()):
+                summary.append(bank_pb2.Write_summary(customer = customer_id, branch = origin, count = count))
+        return bank_pb2.Sync_request(id = self.id, summary = summary)
+
+    def Anti_entropy(self, branch_id):
+        """
+        Pull the missing writes from the branch and apply them like propagate requests, return the number of writes received
+        """
+        stub = self.Get_transport().get_stub(self.branches_bind_addresses[branch_id])
+        received = 0
+        for write in stub.Sync(self.Create_sync_request(), timeout=self.propagate_timeout):
+            self.Deliver_request(write, None)
+            received += 1
+        self.metrics.counter("sync_writes_received_total", branch=branch_id).inc(received)
+        if received:
+            logger.info("Branch %s caught up %s writes from branch %s", self.id, received, branch_id)
+        return received
+
+    def Anti_entropy_service(self):
+        """
+        Background anti-entropy, sync with every branch on start, every sync_interval seconds and when woken up
+        """
+        while not self.sync_stop.is_set():
+            for branch_id in self.branches:
+                if branch_id == self.id or self.sync_stop.is_set():
+                    continue
+                try:
+                    self.Anti_entropy(branch_id)
+                except grpc.RpcError as e:
+                    self.metrics.counter("sync_failures_total", branch=branch_id).inc()
+                    logger.info("Branch %s anti-entropy with branch %s failed with %s", self.id, branch_id, e.code())
+            self.sync_wakeup.wait(self.sync_interval)
+            self.sync_wakeup.clear()
+
+    def Start_anti_entropy(self):
+        """
+        Start the background anti-entropy thread if sync_interval is set
+        """
+        if self.sync_interval <= 0:
+            return
+        threading.Thread(
+            target=self.Anti_entropy_service,
+            name="Branch-{}-anti-entropy".format(self.id),
+            daemon=True
+        ).start()
+
+    def Stop_anti_entropy(self):
+        self.sync_stop.set()
+        self.sync_wakeup.set()
@@ -2,97 +2,297 @@ import grpc
 import bank_pb2
 import bank_pb2_grpc
 import time
-import json
+import collections
+import queue
+import uuid
 
+from channel_pool import get_channel_pool
 from utilities import get_operation, get_source_type_name, configure_logger, get_result_name
 from concurrent import futures
 
 logger = configure_logger("Customer")
 
+# failures a request is resent on, the branch may have processed it so the resend relies on the dedup cache
+RETRYABLE_CODES = (grpc.StatusCode.DEADLINE_EXCEEDED, grpc.StatusCode.UNAVAILABLE)
+
 class Customer:
-    def __init__(self, id, bind_addresses, events):
+    def __init__(self, id, bind_addresses, events, batch_size=1, transport=None, history_size=100, deadline=None, retries=0, hedge_delay=0.0, latencies=None):
         # unique ID of the Customer
         self.id = id
         # events from the input
         self.events = events
-        # a list of received messages used for debugging purpose
-        self.recvMsg = list()
+        # the last history_size received messages used for debugging purpose
+        self.recvMsg = collections.deque(maxlen=history_size)
         # iterate the processID of the branches bind_address
         self.branches_bind_addresses = bind_addresses
-        # iterate the processID of the branches the stub
-        self.stubs = {}
         # local clock
         self.clock = 1
         # last write id, initial value is 0
         self.last_write_id = 0
         # last write branch id, initial value is 0
         self.last_write_branch = 0
-        # write set, initial value is empty list
-        self.write_set = []
+        # write set version vector, branch id -> number of customer writes from the branch, initial value is empty
+        self.write_set = {}
         # customer balance
         self.balance = 0
+        # max number of consecutive events to the same branch sent in one batch request
+        self.batch_size = batch_size
+        # (interface, latency in seconds, result) of each event appended to the caller list, not collected if None
+        # a batch round trip is one ("batch", latency, worst result) sample, its events are recorded with latency None
+        self.latencies = latencies
+        # transport providing get_stub(bind_address), the process channel pool if not given
+        self.transport = transport
+        # current batch window, halved when a branch is busy and grown by one on success up to batch_size (AIMD)
+        self.window = batch_size
+        # max milliseconds between resends of a request rejected by a busy branch, resends go on until the deadline
+        self.max_backoff_ms = 1000
+        # per-request deadline in seconds, None waits forever
+        self.deadline = deadline
+        # max resends of a request failed with a deadline or an unavailable branch, resends reuse the request id
+        self.retries = retries
+        # seconds before a slow query is also sent to a second branch, 0 disables hedging
+        self.hedge_delay = hedge_delay
+        # request ids are unique across customer sessions, session id and a sequence number
+        self.session_id = uuid.uuid4().hex
+        self.request_seq = 0
 
     # TODO: students are expected to create the Customer stub
     def createStub(self, branch_id, branch_bind_address):
         """
         Create stub for each branch
+        The stub comes from the process channel pool, the channel to the branch is reused across events and customers
         """
-        stub = bank_pb2_grpc.BankStub(grpc.insecure_channel(branch_bind_address))
+        transport = self.transport if self.transport is not None else get_channel_pool(len(self.branches_bind_addresses))
+        stub = transport.get_stub(branch_bind_address)
         return stub
 
     # TODO: students are expected to send out the events to the Bank
     def executeEvents(self):
-        for event in self.events:
-            operation = get_operation(event["interface"])
-            branch_id = event["dest"]
-            if event["interface"] == "query":
-                amount = 0
+        for batch in self.groupEvents():
+            branch_id = batch[0]["dest"]
+            requests = [self.createRequest(event) for event in batch]
+            start_time = time.perf_counter()
+            responses = self.sendRequests(branch_id, requests)
+            latency = time.perf_counter() - start_time
+            for event, response in zip(batch, responses):
+                self.handleResponse(event, response)
+            if self.latencies is not None:
+                self.recordLatencies(batch, responses, latency)
+
+    def recordLatencies(self, batch, responses, latency):
+        """
+        Record the round trip of the batch, the latency of a batch is not the latency of each of its events
+        """
+        if len(batch) == 1:
+            self.latencies.append((batch[0]["interface"], latency, get_result_name(responses[0].operation_result)))
+            return
+        worst = max(response.operation_result for response in responses)
+        self.latencies.append(("batch", latency, get_result_name(worst)))
+        for event, response in zip(batch, responses):
+            self.latencies.append((event["interface"], None, get_result_name(response.operation_result)))
+
+    def sendRequests(self, branch_id, requests):
+        """
+        Send the requests to the branch, requests rejected by a busy branch are resent after the retry-after hint
+        until the deadline has passed since the first send, with no deadline until the branch accepts them.
+        A busy branch halves the batch window, a round trip without busy responses grows it by one
+        Requests failed with a deadline or an unavailable branch are resent up to retries times with the same
+        request ids, the branch dedup cache makes the resend safe for deposits and withdraws. A resend reaching the
+        branch while the first request is still processing fails with a deadline too and is resent again.
+        Requests still failing after that get an error response, their outcome is unknown, the session goes on with
+        the next events.
+        """
+        responses = [None] * len(requests)
+        pending = list(range(len(requests)))
+        attempt = 0
+        failures = 0
+        give_up_at = None if self.deadline is None else time.monotonic() + self.deadline
+        while True:
+            try:
+                results = self.sendBatch(branch_id, [requests[index] for index in pending])
+            except grpc.RpcError as e:
+                if e.code() in RETRYABLE_CODES and failures < self.retries:
+                    failures += 1
+                    logger.info("Customer %s request to branch %s failed with %s, retry %s", self.id, branch_id, e.code(), failures)
+                    time.sleep(0.01 * 2 ** failures)
+                    continue
+                # the branch server is over its max concurrent rpcs, back off without a hint
+                if e.code() != grpc.StatusCode.RESOURCE_EXHAUSTED or self.backoffExpired(give_up_at):
+                    logger.info("Customer %s request to branch %s failed with %s, giving up", self.id, branch_id, e.code())
+                    for index in pending:
+                        responses[index] = bank_pb2.MsgDelivery_response(
+                            operation_result = bank_pb2.Result.error,
+                            source_type = bank_pb2.Source.branch,
+                            id = branch_id
+                        )
+                    return responses
+                retry_after_ms = 10 * 2 ** min(attempt, 10)
             else:
-                amount = event["money"]
-            logger.info(">" * 50 + "<" * 50)
-            logger.info("Customer {} sending {} operation to branch {}, amount {}, last write id {}, last write branch {}".format(
-                self.id, 
-                event["interface"], 
-                branch_id,
-                amount,
-                self.last_write_id,
-                self.last_write_branch
-                )
-            )
-            customer_request = bank_pb2.MsgDelivery_request(
-                operation_type = operation,
-                source_type = bank_pb2.Source.customer,
-                id = self.id,
-                amount = amount,
-                clock = self.clock,
-                last_write_id = self.last_write_id,
-                last_write_branch = self.last_write_branch,
-                write_set = json.dumps(self.write_set)
-            )
-            stub = self.createStub(branch_id, self.branches_bind_addresses[branch_id])
-            response = stub.MsgDelivery(customer_request)
-            self.recvMsg.append(response)
-            self.write_set.append({"pid":response.id, "wid": response.last_write_id})
-            logger.info("Customer {} has recevied the response from {} id {}, amount {}, clock {}, last_write_id {}".format(
-                self.id, 
-                get_source_type_name(response.source_type), 
-                response.id,
-                response.amount,
-                response.clock,
-                response.last_write_id
-                )
-            )
-            # the last_write_id change means a write operation, so need to update write_set
-            if response.last_write_id != self.last_write_id:
-                self.last_write_branch = response.id
-                self.last_write_id = response.last_write_id
-            # save the customer balance and export the data later
-            if event["interface"] == "query":
-                self.balance = response.amount
-
-
-def execute_customer_request(id, branch_bind_addresses, events):
-    cust = Customer(id, branch_bind_addresses, events)
+                busy = []
+                retry_after_ms = 0
+                for index, response in zip(pending, results):
+                    responses[index] = response
+                    if response.operation_result == bank_pb2.Result.busy:
+                        busy.append(index)
+                        retry_after_ms = max(retry_after_ms, response.retry_after_ms)
+                pending = busy
+                if not pending:
+                    self.window = min(self.window + 1, self.batch_size)
+                    return responses
+                if self.backoffExpired(give_up_at):
+                    return responses
+            attempt += 1
+            self.window = max(self.window // 2, 1)
+            retry_after_ms = min(retry_after_ms, self.max_backoff_ms)
+            if give_up_at is not None:
+                retry_after_ms = min(retry_after_ms, max(int(1000 * (give_up_at - time.monotonic())), 0))
+            logger.info("Customer %s backing off %sms, branch is busy, batch window %s", self.id, retry_after_ms, self.window)
+            time.sleep(retry_after_ms / 1000)
+
+    def backoffExpired(self, give_up_at):
+        """
+        Whether the busy backoff of a request has run out of its deadline, never without a deadline
+        """
+        return give_up_at is not None and time.monotonic() >= give_up_at
+
+    def sendBatch(self, branch_id, requests):
+        """
+        Send the requests in one round trip, return the responses in request order
+        """
+        stub = self.createStub(branch_id, self.branches_bind_addresses[branch_id])
+        if len(requests) == 1:
+            if self.hedge_delay > 0 and requests[0].operation_type == bank_pb2.Operation.query and len(self.branches_bind_addresses) > 1:
+                return [self.sendHedgedQuery(branch_id, requests[0])]
+            return [stub.MsgDelivery(requests[0], timeout=self.deadline)]
+        # consecutive events to the same branch are pipelined in one round trip, branch processes them in order
+        batch_response = stub.MsgDeliveryBatch(bank_pb2.MsgDelivery_batch_request(requests = requests), timeout=self.deadline)
+        return batch_response.responses
+
+    def sendHedgedQuery(self, branch_id, request):
+        """
+        Send the query to the branch, if it has not answered within hedge_delay send it to the next branch too
+        The first success response wins, otherwise the response of the branch is returned.
+        Queries carry the customer write_set, so a lagging branch answers error instead of a stale balance.
+        """
+        completed = queue.Queue()
+        primary = self.createStub(branch_id, self.branches_bind_addresses[branch_id]).MsgDelivery.future(request, timeout=self.deadline)
+        primary.add_done_callback(completed.put)
+        calls = [primary]
+        try:
+            first = completed.get(timeout=self.hedge_delay)
+        except queue.Empty:
+            first = None
+            hedge_branch = self.nextBranch(branch_id)
+            logger.info("Customer %s query to branch %s is slow, hedging to branch %s", self.id, branch_id, hedge_branch)
+            hedge = self.createStub(hedge_branch, self.branches_bind_addresses[hedge_branch]).MsgDelivery.future(request, timeout=self.deadline)
+            hedge.add_done_callback(completed.put)
+            calls.append(hedge)
+        fallback = None
+        failure = None
+        for index in range(len(calls)):
+            call = first if index == 0 and first is not None else completed.get()
+            try:
+                response = call.result()
+            except grpc.RpcError as e:
+                failure = e
+                continue
+            if response.operation_result == bank_pb2.Result.success:
+                for other in calls:
+                    if other is not call:
+                        other.cancel()
+                return response
+            if fallback is None or call is primary:
+                fallback = response
+        if fallback is not None:
+            return fallback
+        raise failure
+
+    def nextBranch(self, branch_id):
+        """
+        Branch after branch_id in id order, wraps around
+        """
+        branch_ids = sorted(self.branches_bind_addresses)
+        return branch_ids[(branch_ids.index(branch_id) + 1) % len(branch_ids)]
+
+    def groupEvents(self):
+        """
+        Group consecutive events with the same destination branch into batches of at most window events
+        """
+        batch = []
+        for event in self.events:
+            if batch and (batch[0]["dest"] != event["dest"] or len(batch) >= self.window):
+                yield batch
+                batch = []
+            batch.append(event)
+        if batch:
+            yield batch
+
+    def createRequest(self, event):
+        """
+        Build the customer request of the event
+        """
+        operation = get_operation(event["interface"])
+        branch_id = event["dest"]
+        if event["interface"] == "query":
+            amount = 0
+        else:
+            amount = event["money"]
+        logger.info(">" * 50 + "<" * 50)
+        logger.info(
+            "Customer %s sending %s operation to branch %s, amount %s, last write id %s, last write branch %s",
+            self.id,
+            event["interface"],
+            branch_id,
+            amount,
+            self.last_write_id,
+            self.last_write_branch
+        )
+        self.request_seq += 1
+        customer_request = bank_pb2.MsgDelivery_request(
+            operation_type = operation,
+            source_type = bank_pb2.Source.customer,
+            id = self.id,
+            amount = amount,
+            clock = self.clock,
+            last_write_id = self.last_write_id,
+            last_write_branch = self.last_write_branch,
+            write_set = self.write_set,
+            request_id = "{}-{}".format(self.session_id, self.request_seq)
+        )
+        return customer_request
+
+    def handleResponse(self, event, response):
+        """
+        Update the customer session state from the branch response of the event
+        """
+        self.recvMsg.append(response)
+        logger.info(
+            "Customer %s has recevied the response from %s id %s, amount %s, clock %s, last_write_id %s",
+            self.id,
+            get_source_type_name(response.source_type),
+            response.id,
+            response.amount,
+            response.clock,
+            response.last_write_id
+        )
+        # error response means branch has not got all of the writes yet or the outcome is unknown, busy response means
+        # branch has rejected the request, neither carries the session state or the balance
+        if response.operation_result in (bank_pb2.Result.error, bank_pb2.Result.busy):
+            return
+        # merge the branch write_set of the customer
+        for branch, count in response.write_set.items():
+            if count > self.write_set.get(branch, 0):
+                self.write_set[branch] = count
+        # the last_write_id change means a write operation, so need to update write_set
+        if response.last_write_id != self.last_write_id:
+            self.last_write_branch = response.id
+            self.last_write_id = response.last_write_id
+        # save the customer balance and export the data later
+        if event["interface"] == "query":
+            self.balance = response.amount
+
+
+def execute_customer_request(id, branch_bind_addresses, events, batch_size=1, latencies=None, transport=None, deadline=None, retries=0, hedge_delay=0.0):
+    cust = Customer(id, branch_bind_addresses, events, batch_size, transport, deadline=deadline, retries=retries, hedge_delay=hedge_delay, latencies=latencies)
     cust.executeEvents()
     return {"id": cust.id, "balance": cust.balance}
-
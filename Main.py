@@ -1,5 +1,7 @@
 import argparse
+import collections
 import multiprocessing
+import os
 import pdb
 import time
 import grpc
@@ -8,97 +10,525 @@ import bank_pb2_grpc
 import json
 import jsbeautifier
 import re
+import shutil
+import tempfile
+import threading
 
 from concurrent import futures
 
 from Branch import Branch
+from channel_pool import get_channel_pool
 from Customer import execute_customer_request
-from utilities import configure_logger, get_operation_name, get_result_name, get_source_type_name, get_system_free_tcp_port, get_json_data
+from profiler import SamplingProfiler, install_profile_signal_handler, stop_and_write_profile, get_profile_file_name, merge_collapsed
+from simulation import SimulatedNetwork
+from utilities import configure_logger, configure_logging, stop_log_listener, get_operation_name, get_result_name, get_source_type_name, get_system_free_tcp_port, get_json_data, iter_jsonl, get_unix_socket_address
 
 logger = configure_logger("main")
 
 # argparse refer https://docs.python.org/3/howto/argparse.html
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser(description="Input and output files")
     parser.add_argument("-i", "--input", required=False, type=str, default="input.json", help="Input file name wiht json format")
     parser.add_argument("-o", "--output", required=False, type=str, default="output.json",help="Output file name wiht json format")
-    args = parser.parse_args()
-    return args.input.strip(), args.output.strip()
+    parser.add_argument("--propagate-policy", required=False, type=str, default="all", choices=["all", "quorum", "async"], help="Branch propagate completion policy")
+    parser.add_argument("--propagate-timeout", required=False, type=float, default=5.0, help="Per-branch propagate deadline in seconds")
+    parser.add_argument("--propagate-retries", required=False, type=int, default=3, help="Max background retries for a failed propagate request")
+    parser.add_argument("--branch-workers", required=False, type=int, default=10, help="Number of gRPC server worker threads per branch")
+    parser.add_argument("--customer-workers", required=False, type=int, default=1, help="Number of customer sessions executed concurrently")
+    parser.add_argument("--startup-timeout", required=False, type=float, default=10.0, help="Seconds to wait for all branches to be ready")
+    parser.add_argument("--shutdown-timeout", required=False, type=float, default=10.0, help="Seconds to wait for branches to drain and stop")
+    parser.add_argument("--customer-batch-size", required=False, type=int, default=1, help="Max consecutive customer events to the same branch sent in one batch request")
+    parser.add_argument("--propagate-batch-size", required=False, type=int, default=1, help="Max pending writes coalesced into one batch propagate request per branch")
+    parser.add_argument("--metrics-dir", required=False, type=str, default=None, help="Directory of the per-branch metrics dump files, disabled if not given")
+    parser.add_argument("--metrics-interval", required=False, type=float, default=5.0, help="Seconds between metrics dumps")
+    parser.add_argument("--log-level", required=False, type=str, default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Log level, write_set dumps are logged at DEBUG")
+    parser.add_argument("--sync-logging", action="store_true", help="Write log records on the calling thread instead of the background log listener")
+    parser.add_argument("--session-wait", required=False, type=float, default=0.0, help="Seconds a customer request waits for missing writes before returning error, 0 returns error immediately")
+    parser.add_argument("--sync-interval", required=False, type=float, default=0.0, help="Seconds between anti-entropy rounds of every branch, 0 disables anti-entropy")
+    parser.add_argument("--stream", action="store_true", help="Read the input as JSON Lines and write the output incrementally, implied by a .jsonl input file")
+    parser.add_argument("--transport", required=False, type=str, default="tcp", choices=["tcp", "uds", "sim"], help="Branch transport, uds uses unix domain sockets for branches on the same host, sim runs every branch in process over a simulated network")
+    parser.add_argument("--socket-dir", required=False, type=str, default=None, help="Directory of the branch unix domain sockets, a temporary directory if not given")
+    parser.add_argument("--replication-factor", required=False, type=int, default=0, help="Number of branches each customer is replicated to by consistent hashing, every customer gets its own account starting with the branch balance, 0 replicates to every branch")
+    parser.add_argument("--admission-limit", required=False, type=int, default=0, help="Max customer requests per branch waiting for one of the --branch-workers before rejecting with busy, 0 is unbounded, admission is off unless this or --propagate-admission-limit is given")
+    parser.add_argument("--propagate-admission-limit", required=False, type=int, default=0, help="Max propagate requests per branch waiting for one of the --branch-workers before rejecting with busy, propagate requests are served before customer requests, 0 is unbounded")
+    parser.add_argument("--max-concurrent-rpcs", required=False, type=int, default=None, help="gRPC server bound of concurrent rpcs per branch, further rpcs fail with RESOURCE_EXHAUSTED")
+    parser.add_argument("--customer-deadline", required=False, type=float, default=None, help="Per-request deadline of the customers in seconds, wait forever if not given")
+    parser.add_argument("--customer-retries", required=False, type=int, default=0, help="Max resends of a customer request failed with a deadline or an unavailable branch")
+    parser.add_argument("--hedge-delay", required=False, type=float, default=0.0, help="Seconds before a slow query is also sent to the next branch, 0 disables hedged queries")
+    parser.add_argument("--dedup-size", required=False, type=int, default=10000, help="Max customer request ids remembered per branch for deduplication")
+    parser.add_argument("--dedup-ttl", required=False, type=float, default=60.0, help="Seconds a customer request id is remembered per branch")
+    parser.add_argument("--data-dir", required=False, type=str, default=None, help="Directory of the branch WAL and snapshots, branches resume from it on restart, state is kept only in memory if not given")
+    parser.add_argument("--wal-sync-interval", required=False, type=float, default=0.0, help="Seconds the WAL waits to gather more writes into one fsync, 0 syncs as soon as the previous fsync is done")
+    parser.add_argument("--snapshot-interval", required=False, type=int, default=1000, help="Number of writes between branch snapshots, bounds the WAL replayed on restart")
+    parser.add_argument("--op-log-dir", required=False, type=str, default=None, help="Directory of the branch_<id>.ops operation logs verified offline by checker.py, disabled if not given")
+    parser.add_argument("--profile", action="store_true", help="Sample every branch for the whole run and merge the profiles in --profile-dir at the end")
+    parser.add_argument("--profile-dir", required=False, type=str, default="profiles", help="Directory of the branch_<id>.collapsed profiles, SIGUSR1 toggles profiling of a running branch")
+    parser.add_argument("--profile-interval", required=False, type=float, default=0.005, help="Seconds between profiler samples")
+    parser.add_argument("--sim-seed", required=False, type=int, default=0, help="Random seed of the simulated network latency and loss")
+    parser.add_argument("--sim-latency", required=False, type=float, default=0.0, help="Simulated one-way latency in seconds")
+    parser.add_argument("--sim-jitter", required=False, type=float, default=0.0, help="Max simulated random latency in seconds added to --sim-latency")
+    parser.add_argument("--sim-loss", required=False, type=float, default=0.0, help="Probability a simulated branch to branch message is lost")
+    args = parser.parse_args(argv)
+    args.input = args.input.strip()
+    args.output = args.output.strip()
+    return args
 
-def create_branch_input_data_collection(input_file):
+def create_branch_data(data, socket_dir=None):
+    """
+    Build the branch data of the input branch and assign its bind address
+    The branch listens on a unix domain socket in socket_dir if given, otherwise on a free TCP port
+    """
+    branch = {}
+    branch["id"] = data["id"]
+    branch["balance"] = data["balance"]
+    if socket_dir is not None:
+        bind_address = get_unix_socket_address(socket_dir, data["id"])
+    else:
+        port = get_system_free_tcp_port()
+        bind_address = "[::]:{}".format(port)
+    branch["bind_address"] = bind_address
+    return branch
+
+def create_socket_dir(args):
+    """
+    Return the directory of the branch unix domain sockets for the uds transport, None for tcp
+    """
+    if args.transport != "uds":
+        return None
+    if args.socket_dir is not None:
+        os.makedirs(args.socket_dir, exist_ok=True)
+        return args.socket_dir
+    return tempfile.mkdtemp(prefix="bank-")
+
+def remove_socket_dir(args, socket_dir):
+    """
+    Remove the temporary socket directory created by create_socket_dir
+    """
+    if socket_dir is not None and args.socket_dir is None:
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+def create_branch_input_data_collection(input_file, socket_dir=None):
     branches_data = []
     customers_events_data = []
-    input_json_data = get_json_data(input_file)
+    input_json_data = iter_jsonl(input_file) if input_file.endswith(".jsonl") else get_json_data(input_file)
     for data in input_json_data:
         if data["type"] == "branch":
-            branch = {}
-            branch["id"] = data["id"]
-            branch["balance"] = data["balance"]
-            port = get_system_free_tcp_port()
-            bind_address = "[::]:{}".format(port)
-            branch["bind_address"] = bind_address
-            branches_data.append(branch)
+            branches_data.append(create_branch_data(data, socket_dir))
         if data["type"] == "customer":
             customers_events_data.append(data)
     return branches_data, customers_events_data
 
-def branch_service(branch, branches_bind_addresses, output):
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=1,),)
+def metrics_dump_service(branch, metrics_dir, interval, stop):
+    """
+    Dump the branch metrics to metrics_dir/branch_<id>_metrics.json every interval seconds until stop is set
+    """
+    file_name = os.path.join(metrics_dir, "branch_{}_metrics.json".format(branch.id))
+    while not stop.wait(interval):
+        branch.Dump_metrics(file_name)
+
+def branch_service(branch, branches_bind_addresses, output, max_workers=10, ready=None, stop=None, drain_timeout=5.0, metrics_dir=None, metrics_interval=5.0, max_concurrent_rpcs=None, profile_dir="profiles", profile=False, profile_interval=0.005):
+    #SIGUSR1 toggles the profiler, --profile runs it from start to stop
+    profiler = SamplingProfiler(profile_interval)
+    install_profile_signal_handler(profiler, profile_dir, "branch_{}".format(branch.id))
+    if profile:
+        profiler.start()
+    #resume from the snapshot and WAL before serving anything
+    branch.Open_storage()
+    #the requests waiting for admission hold a server thread too
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers + branch.Admission_queue_capacity(),), maximum_concurrent_rpcs=max_concurrent_rpcs)
     bank_pb2_grpc.add_BankServicer_to_server(branch, server)
     server.add_insecure_port(branches_bind_addresses[branch.id])
     server.start()
-    logger.info("Branch {} started with balance {} and is litsening on TCP port {}".format(
-        branch.id, branch.balance, 
-        branches_bind_addresses[branch.id].split(":")[-1]
-        )
+    logger.info(
+        "Branch %s started with balance %s and is litsening on %s",
+        branch.id,
+        branch.balance,
+        branches_bind_addresses[branch.id]
     )
-    server.wait_for_termination()
+    if metrics_dir is not None:
+        metrics_stop = threading.Event()
+        metrics_thread = threading.Thread(
+            target=metrics_dump_service,
+            args=(branch, metrics_dir, metrics_interval, metrics_stop),
+            name="Branch-{}-metrics".format(branch.id),
+            daemon=True
+        )
+        metrics_thread.start()
+    branch.Start_anti_entropy()
+    #signal main the branch is listening
+    if ready is not None:
+        ready.set()
+    if stop is None:
+        server.wait_for_termination()
+        return
+    stop.wait()
+    branch.Stop_anti_entropy()
+    #finish the outstanding propagate requests before stop serving, so peers receive every write
+    if not branch.Drain_propagate(drain_timeout):
+        logger.info("Branch %s stopped with propagate requests still pending", branch.id)
+    server.stop(grace=drain_timeout).wait()
+    get_channel_pool().close()
+    branch.Close_storage()
+    if profiler.is_running():
+        stop_and_write_profile(profiler, profile_dir, "branch_{}".format(branch.id))
+    if metrics_dir is not None:
+        metrics_stop.set()
+        metrics_thread.join()
+        branch.Dump_metrics(os.path.join(metrics_dir, "branch_{}_metrics.json".format(branch.id)))
+    logger.info("Branch %s stopped", branch.id)
+    #the branch process exits without running atexit handlers, flush the queued log records here
+    stop_log_listener()
 
-def main():
-    input_file, output_file = get_args()
-    branches_data, customers_data = create_branch_input_data_collection(input_file)
+def start_branches(branches_instances, branches_bind_addresses, branch_output, branch_workers=10, drain_timeout=5.0, metrics_dir=None, metrics_interval=5.0, max_concurrent_rpcs=None, profile_dir="profiles", profile=False, profile_interval=0.005):
+    """
+    Start one process per branch
+    Return the processes, the ready event of each branch and the stop event shared by all of branches
+    """
+    workers = []
+    ready_events = []
+    stop_event = multiprocessing.Event()
+    for instance in branches_instances:
+        ready_event = multiprocessing.Event()
+        branch_worker = multiprocessing.Process(
+            name="Branch-{}".format(instance.id),
+            target=branch_service,
+            args=(
+                instance,
+                branches_bind_addresses,
+                branch_output,
+                branch_workers,
+                ready_event,
+                stop_event,
+                drain_timeout,
+                metrics_dir,
+                metrics_interval,
+                max_concurrent_rpcs,
+                profile_dir,
+                profile,
+                profile_interval,
+            ),
+        )
+        branch_worker.start()
+        workers.append(branch_worker)
+        ready_events.append(ready_event)
+    return workers, ready_events, stop_event
+
+def wait_for_branches(workers, ready_events, branches_bind_addresses, timeout=10.0):
+    """
+    Wait until every branch signaled ready and its channel is connected
+    Raise RuntimeError if a branch exits or is not ready within timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    for worker, ready_event in zip(workers, ready_events):
+        while not ready_event.wait(0.05):
+            if not worker.is_alive():
+                raise RuntimeError("{} exited before it was ready".format(worker.name))
+            if time.monotonic() > deadline:
+                raise RuntimeError("{} was not ready within {}s".format(worker.name, timeout))
+    channel_pool = get_channel_pool(len(branches_bind_addresses))
+    for branch_id, bind_address in branches_bind_addresses.items():
+        if not channel_pool.is_healthy(bind_address, max(deadline - time.monotonic(), 0.1)):
+            raise RuntimeError("Branch {} is not reachable on {}".format(branch_id, bind_address))
+
+def stop_branches(workers, stop_event, timeout=10.0):
+    """
+    Ask every branch to drain and stop, terminate the branches which do not exit within timeout seconds
+    """
+    stop_event.set()
+    deadline = time.monotonic() + timeout
+    for worker in workers:
+        worker.join(max(deadline - time.monotonic(), 0))
+        if worker.is_alive():
+            logger.info("%s did not stop within %ss, terminating", worker.name, timeout)
+            worker.terminate()
+            worker.join()
+
+def create_branches_instances(branches_data, args, transport=None):
+    """
+    Create the Branch instances of the input branches, return the instances and the bind address of each branch
+    """
     list_of_branches_id = [branch["id"] for branch in branches_data]
     branches_bind_addresses = {branch["id"]:branch["bind_address"] for branch in branches_data}
-    manager = multiprocessing.Manager()
-    branch_output = manager.list()
-    #creating the branch instance
     branches_instances = []
     for branch in branches_data:
         branch_object = Branch(
             id=branch["id"], 
             balance=branch["balance"], 
             branches=list_of_branches_id, 
-            bind_addresses=branches_bind_addresses
+            bind_addresses=branches_bind_addresses,
+            propagate_policy=args.propagate_policy,
+            propagate_timeout=args.propagate_timeout,
+            propagate_retries=args.propagate_retries,
+            propagate_batch_size=args.propagate_batch_size,
+            session_wait=args.session_wait,
+            sync_interval=args.sync_interval,
+            transport=transport,
+            replication_factor=args.replication_factor,
+            customer_admission_limit=args.admission_limit,
+            branch_admission_limit=args.propagate_admission_limit,
+            worker_slots=args.branch_workers if args.admission_limit or args.propagate_admission_limit else 0,
+            dedup_size=args.dedup_size,
+            dedup_ttl=args.dedup_ttl,
+            data_dir=args.data_dir,
+            wal_sync_interval=args.wal_sync_interval,
+            snapshot_interval=args.snapshot_interval,
+            op_log_dir=args.op_log_dir
         )
         branches_instances.append(branch_object)
-    
-    workers = []
-    for instance in branches_instances:
-        branch_worker = multiprocessing.Process(
-            name="Branch-{}".format(instance.id),
-            target=branch_service,
-            args=(instance, branches_bind_addresses, branch_output,),
-        )
-        branch_worker.start()
-        workers.append(branch_worker)
-    #Add delay to let branch to be ready for serve customer
-    time.sleep(1)
-    output = []
-    for customer in customers_data:
-        customer_id = customer["id"]
-        result = execute_customer_request(customer_id, branches_bind_addresses, customer["events"])
-        output.append(result)
-    
-    #Wait for branch export event to output
-    time.sleep(2)
-    json_output = json.dumps(output, indent = 4)
-
-    with open(output_file, "w") as file:
-        file.write(json_output)
-    logger.info("Data has exported to file {}".format(output_file))
+    return branches_instances, branches_bind_addresses
 
-    for worker in workers:
-        worker.terminate()
+def get_customer_options(args):
+    """
+    Deadline, retry and hedging options of the customer sessions
+    """
+    return {
+        "deadline": args.customer_deadline,
+        "retries": args.customer_retries,
+        "hedge_delay": args.hedge_delay,
+    }
+
+def run_customers(customers_data, branches_bind_addresses, customer_workers=1, batch_size=1, latencies=None, transport=None, customer_options=None):
+    """
+    Execute the customer sessions, up to customer_workers sessions run concurrently on a thread pool
+    Results are returned in input order, per-event latencies are appended to latencies if given
+    """
+    start_time = time.perf_counter()
+    if customer_workers > 1:
+        with futures.ThreadPoolExecutor(max_workers=customer_workers, thread_name_prefix="Customer") as executor:
+            output = list(executor.map(
+                lambda customer: execute_customer_request(customer["id"], branches_bind_addresses, customer["events"], batch_size, latencies, transport, **(customer_options or {})),
+                customers_data
+            ))
+    else:
+        output = []
+        for customer in customers_data:
+            customer_id = customer["id"]
+            result = execute_customer_request(customer_id, branches_bind_addresses, customer["events"], batch_size, latencies, transport, **(customer_options or {}))
+            output.append(result)
+    elapsed = time.perf_counter() - start_time
+    events_count = sum(len(customer["events"]) for customer in customers_data)
+    logger.info(
+        "%s customers with %s events completed in %.3fs by %s workers, throughput %.1f events/s",
+        len(customers_data),
+        events_count,
+        elapsed,
+        customer_workers,
+        events_count / elapsed if elapsed > 0 else 0
+    )
+    return output
+
+def launch_branches(branches_data, args, branch_output=None):
+    """
+    Start the branches and wait for them to be ready
+    Return the branch processes, the stop event and the bind address of each branch
+    """
+    if args.metrics_dir is not None:
+        os.makedirs(args.metrics_dir, exist_ok=True)
+    #creating the branch instance
+    branches_instances, branches_bind_addresses = create_branches_instances(branches_data, args)
+    workers, ready_events, stop_event = start_branches(
+        branches_instances,
+        branches_bind_addresses,
+        branch_output,
+        args.branch_workers,
+        args.propagate_timeout,
+        args.metrics_dir,
+        args.metrics_interval,
+        args.max_concurrent_rpcs,
+        args.profile_dir,
+        args.profile,
+        args.profile_interval
+    )
+    #Wait for branches to be ready for serve customer
+    try:
+        wait_for_branches(workers, ready_events, branches_bind_addresses, args.startup_timeout)
+    except RuntimeError:
+        stop_branches(workers, stop_event, args.shutdown_timeout)
+        raise
+    logger.info("All %s branches are ready", len(workers))
+    return workers, stop_event, branches_bind_addresses
+
+def simulate(branches_data, customers_data, args, latencies=None):
+    """
+    Run the branches and customers in this process over the simulated network, return the customer results
+    Stubs call the Branch servicers directly, so there is no branch process, gRPC server or serialization.
+    """
+    for branch in branches_data:
+        branch["bind_address"] = "sim:{}".format(branch["id"])
+    network = SimulatedNetwork(args.sim_seed, args.sim_latency, args.sim_jitter, args.sim_loss)
+    branches_instances, branches_bind_addresses = create_branches_instances(branches_data, args, network)
+    for branch in branches_instances:
+        network.register(branches_bind_addresses[branch.id], branch)
+        branch.Open_storage()
+        branch.Start_anti_entropy()
+    logger.info(
+        "%s branches are simulated with seed %s, latency %ss, jitter %ss, loss %s",
+        len(branches_instances),
+        args.sim_seed,
+        args.sim_latency,
+        args.sim_jitter,
+        args.sim_loss
+    )
+    try:
+        output = run_customers(customers_data, branches_bind_addresses, args.customer_workers, args.customer_batch_size, latencies, network, get_customer_options(args))
+    finally:
+        for branch in branches_instances:
+            branch.Stop_anti_entropy()
+            if not branch.Drain_propagate(args.shutdown_timeout):
+                logger.info("Branch %s stopped with propagate requests still pending", branch.id)
+        network.close()
+        for branch in branches_instances:
+            branch.Close_storage()
+    if args.metrics_dir is not None:
+        os.makedirs(args.metrics_dir, exist_ok=True)
+        for branch in branches_instances:
+            branch.Dump_metrics(os.path.join(args.metrics_dir, "branch_{}_metrics.json".format(branch.id)))
+    return output
+
+def iter_customer_results(customers, branches_bind_addresses, customer_workers=1, batch_size=1, customer_options=None):
+    """
+    Execute the customer sessions as they are read from customers and yield the results in input order
+    At most 2 * customer_workers sessions are in flight, so memory does not grow with the number of customers
+    """
+    window = max(customer_workers, 1) * 2
+    with futures.ThreadPoolExecutor(max_workers=max(customer_workers, 1), thread_name_prefix="Customer") as executor:
+        pending = collections.deque()
+        for customer in customers:
+            pending.append(executor.submit(
+                execute_customer_request,
+                customer["id"],
+                branches_bind_addresses,
+                customer["events"],
+                batch_size,
+                **(customer_options or {})
+            ))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def write_json_array(file, items):
+    """
+    Write the items to the file one by one as a json array, same layout as json.dumps(items, indent = 4)
+    Return the number of items written
+    """
+    count = 0
+    for item in items:
+        file.write("[\n" if count == 0 else ",\n")
+        file.write("\n".join("    " + line for line in json.dumps(item, indent = 4).splitlines()))
+        count += 1
+    file.write("\n]" if count else "[]")
+    return count
+
+def run_stream(args):
+    """
+    Streaming mode, read the JSON Lines input with a generator pipeline
+    Branch lines must come before customer lines, branches are started at the first customer line and
+    customer sessions are dispatched as they are parsed, results are written to the output file incrementally.
+    A json array input is read at once and its branches are started first, only the output is streamed.
+    """
+    if args.input.endswith(".jsonl"):
+        records = iter_jsonl(args.input)
+    else:
+        data = get_json_data(args.input)
+        records = iter([item for item in data if item["type"] == "branch"] + [item for item in data if item["type"] != "branch"])
+    socket_dir = create_socket_dir(args)
+    branches_data = []
+    first_customer = None
+    for data in records:
+        if data["type"] == "branch":
+            branches_data.append(create_branch_data(data, socket_dir))
+        elif data["type"] == "customer":
+            first_customer = data
+            break
+    if not branches_data:
+        remove_socket_dir(args, socket_dir)
+        raise ValueError("No branch is listed before the first customer of {}, branch lines must come first".format(args.input))
+    workers, stop_event, branches_bind_addresses = launch_branches(branches_data, args)
+
+    def customers():
+        if first_customer is not None:
+            yield first_customer
+        for data in records:
+            if data["type"] == "branch":
+                raise ValueError("Branch {} is listed after the first customer".format(data["id"]))
+            if data["type"] == "customer":
+                yield data
+
+    start_time = time.perf_counter()
+    try:
+        with open(args.output, "w") as file:
+            count = write_json_array(
+                file,
+                iter_customer_results(customers(), branches_bind_addresses, args.customer_workers, args.customer_batch_size, get_customer_options(args))
+            )
+    finally:
+        get_channel_pool().close()
+        stop_branches(workers, stop_event, args.shutdown_timeout)
+        remove_socket_dir(args, socket_dir)
+    if args.profile:
+        collect_profiles(args, [branch["id"] for branch in branches_data])
+    elapsed = time.perf_counter() - start_time
+    logger.info(
+        "%s customers streamed to file %s in %.3fs, throughput %.1f customers/s",
+        count,
+        args.output,
+        elapsed,
+        count / elapsed if elapsed > 0 else 0
+    )
+
+def collect_profiles(args, branch_ids):
+    """
+    Merge the branch profiles of the run into profile_dir/branches.collapsed
+    """
+    file_names = [get_profile_file_name(args.profile_dir, "branch_{}".format(branch_id)) for branch_id in branch_ids]
+    file_names = [file_name for file_name in file_names if os.path.exists(file_name)]
+    if len(file_names) < len(branch_ids):
+        logger.info("%s of %s branch profiles are missing", len(branch_ids) - len(file_names), len(branch_ids))
+    if file_names:
+        merged = merge_collapsed(file_names, get_profile_file_name(args.profile_dir, "branches"))
+        logger.info("Profiles of %s branches are merged to file %s", len(file_names), merged)
+
+def main():
+    args = get_args()
+    configure_logging(args.log_level, not args.sync_logging)
+    if args.transport == "sim":
+        branches_data, customers_data = create_branch_input_data_collection(args.input)
+        #every simulated branch runs in this process, so there is one profile of the whole simulation
+        profiler = SamplingProfiler(args.profile_interval)
+        if args.profile:
+            profiler.start()
+        output = simulate(branches_data, customers_data, args)
+        if args.profile:
+            stop_and_write_profile(profiler, args.profile_dir, "simulation")
+        with open(args.output, "w") as file:
+            file.write(json.dumps(output, indent = 4))
+        logger.info("Data has exported to file %s", args.output)
+        return
+    if args.stream or args.input.endswith(".jsonl"):
+        run_stream(args)
+        return
+    input_file, output_file = args.input, args.output
+    socket_dir = create_socket_dir(args)
+    branches_data, customers_data = create_branch_input_data_collection(input_file, socket_dir)
+    manager = multiprocessing.Manager()
+    branch_output = manager.list()
+    workers, stop_event, branches_bind_addresses = launch_branches(branches_data, args, branch_output)
+    try:
+        output = run_customers(customers_data, branches_bind_addresses, args.customer_workers, args.customer_batch_size, customer_options=get_customer_options(args))
+
+        json_output = json.dumps(output, indent = 4)
+
+        with open(output_file, "w") as file:
+            file.write(json_output)
+        logger.info("Data has exported to file %s", output_file)
+    finally:
+        #stop the branches whatever happened to the customers, the branch processes would keep the run alive
+        get_channel_pool().close()
+        stop_branches(workers, stop_event, args.shutdown_timeout)
+        remove_socket_dir(args, socket_dir)
+    if args.profile:
+        collect_profiles(args, [branch["id"] for branch in branches_data])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
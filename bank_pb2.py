@@ -13,23 +13,39 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nbank.proto\x12\x03\x61pp\"\xcf\x01\n\x13MsgDelivery_request\x12&\n\x0eoperation_type\x18\x01 \x01(\x0e\x32\x0e.app.Operation\x12 \n\x0bsource_type\x18\x02 \x01(\x0e\x32\x0b.app.Source\x12\n\n\x02id\x18\x03 \x01(\x05\x12\x0e\n\x06\x61mount\x18\x04 \x01(\x05\x12\r\n\x05\x63lock\x18\x05 \x01(\x05\x12\x15\n\rlast_write_id\x18\x06 \x01(\x05\x12\x19\n\x11last_write_branch\x18\x07 \x01(\x05\x12\x11\n\twrite_set\x18\x08 \x01(\t\"\xa1\x01\n\x14MsgDelivery_response\x12%\n\x10operation_result\x18\x01 \x01(\x0e\x32\x0b.app.Result\x12 \n\x0bsource_type\x18\x02 \x01(\x0e\x32\x0b.app.Source\x12\n\n\x02id\x18\x03 \x01(\x05\x12\x0e\n\x06\x61mount\x18\x04 \x01(\x05\x12\r\n\x05\x63lock\x18\x05 \x01(\x05\x12\x15\n\rlast_write_id\x18\x06 \x01(\x05*1\n\tOperation\x12\t\n\x05query\x10\x00\x12\x0c\n\x08withdraw\x10\x01\x12\x0b\n\x07\x64\x65posit\x10\x02*-\n\x06Result\x12\x0b\n\x07success\x10\x00\x12\x0b\n\x07\x66\x61ilure\x10\x01\x12\t\n\x05\x65rror\x10\x02*\"\n\x06Source\x12\x0c\n\x08\x63ustomer\x10\x00\x12\n\n\x06\x62ranch\x10\x01\x32L\n\x04\x42\x61nk\x12\x44\n\x0bMsgDelivery\x12\x18.app.MsgDelivery_request\x1a\x19.app.MsgDelivery_response\"\x00\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nbank.proto\x12\x03\x61pp\"\xd7\x02\n\x13MsgDelivery_request\x12&\n\x0eoperation_type\x18\x01 \x01(\x0e\x32\x0e.app.Operation\x12 \n\x0bsource_type\x18\x02 \x01(\x0e\x32\x0b.app.Source\x12\n\n\x02id\x18\x03 \x01(\x05\x12\x0e\n\x06\x61mount\x18\x04 \x01(\x05\x12\r\n\x05\x63lock\x18\x05 \x01(\x05\x12\x15\n\rlast_write_id\x18\x06 \x01(\x05\x12\x19\n\x11last_write_branch\x18\x07 \x01(\x05\x12\x39\n\twrite_set\x18\t \x03(\x0b\x32&.app.MsgDelivery_request.WriteSetEntry\x12\x12\n\nrequest_id\x18\n \x01(\t\x12\x13\n\x0bwrite_count\x18\x0b \x01(\x05\x1a/\n\rWriteSetEntry\x12\x0b\n\x03key\x18\x01 \x01(\x05\x12\r\n\x05value\x18\x02 \x01(\x05:\x02\x38\x01J\x04\x08\x08\x10\t\"\xa6\x02\n\x14MsgDelivery_response\x12%\n\x10operation_result\x18\x01 \x01(\x0e\x32\x0b.app.Result\x12 \n\x0bsource_type\x18\x02 \x01(\x0e\x32\x0b.app.Source\x12\n\n\x02id\x18\x03 \x01(\x05\x12\x0e\n\x06\x61mount\x18\x04 \x01(\x05\x12\r\n\x05\x63lock\x18\x05 \x01(\x05\x12\x15\n\rlast_write_id\x18\x06 \x01(\x05\x12:\n\twrite_set\x18\x07 \x03(\x0b\x32\'.app.MsgDelivery_response.WriteSetEntry\x12\x16\n\x0eretry_after_ms\x18\x08 \x01(\x05\x1a/\n\rWriteSetEntry\x12\x0b\n\x03key\x18\x01 \x01(\x05\x12\r\n\x05value\x18\x02 \x01(\x05:\x02\x38\x01\"G\n\x19MsgDelivery_batch_request\x12*\n\x08requests\x18\x01 \x03(\x0b\x32\x18.app.MsgDelivery_request\"J\n\x1aMsgDelivery_batch_response\x12,\n\tresponses\x18\x01 \x03(\x0b\x32\x19.app.MsgDelivery_response\"@\n\rWrite_summary\x12\x10\n\x08\x63ustomer\x18\x01 \x01(\x05\x12\x0e\n\x06\x62ranch\x18\x02 \x01(\x05\x12\r\n\x05\x63ount\x18\x03 \x01(\x05\"?\n\x0cSync_request\x12\n\n\x02id\x18\x01 \x01(\x05\x12#\n\x07summary\x18\x02 \x03(\x0b\x32\x12.app.Write_summary*1\n\tOperation\x12\t\n\x05query\x10\x00\x12\x0c\n\x08withdraw\x10\x01\x12\x0b\n\x07\x64\x65posit\x10\x02*7\n\x06Result\x12\x0b\n\x07success\x10\x00\x12\x0b\n\x07\x66\x61ilure\x10\x01\x12\t\n\x05\x65rror\x10\x02\x12\x08\n\x04\x62usy\x10\x03*\"\n\x06Source\x12\x0c\n\x08\x63ustomer\x10\x00\x12\n\n\x06\x62ranch\x10\x01\x32\xdc\x01\n\x04\x42\x61nk\x12\x44\n\x0bMsgDelivery\x12\x18.app.MsgDelivery_request\x1a\x19.app.MsgDelivery_response\"\x00\x12U\n\x10MsgDeliveryBatch\x12\x1e.app.MsgDelivery_batch_request\x1a\x1f.app.MsgDelivery_batch_response\"\x00\x12\x37\n\x04Sync\x12\x11.app.Sync_request\x1a\x18.app.MsgDelivery_request\"\x00\x30\x01\x62\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'bank_pb2', globals())
 if _descriptor._USE_C_DESCRIPTORS == False:
 
   DESCRIPTOR._options = None
-  _OPERATION._serialized_start=393
-  _OPERATION._serialized_end=442
-  _RESULT._serialized_start=444
-  _RESULT._serialized_end=489
-  _SOURCE._serialized_start=491
-  _SOURCE._serialized_end=525
+  _MSGDELIVERY_REQUEST_WRITESETENTRY._options = None
+  _MSGDELIVERY_REQUEST_WRITESETENTRY._serialized_options = b'8\001'
+  _MSGDELIVERY_RESPONSE_WRITESETENTRY._options = None
+  _MSGDELIVERY_RESPONSE_WRITESETENTRY._serialized_options = b'8\001'
+  _OPERATION._serialized_start=942
+  _OPERATION._serialized_end=991
+  _RESULT._serialized_start=993
+  _RESULT._serialized_end=1048
+  _SOURCE._serialized_start=1050
+  _SOURCE._serialized_end=1084
   _MSGDELIVERY_REQUEST._serialized_start=20
-  _MSGDELIVERY_REQUEST._serialized_end=227
-  _MSGDELIVERY_RESPONSE._serialized_start=230
-  _MSGDELIVERY_RESPONSE._serialized_end=391
-  _BANK._serialized_start=527
-  _BANK._serialized_end=603
+  _MSGDELIVERY_REQUEST._serialized_end=363
+  _MSGDELIVERY_REQUEST_WRITESETENTRY._serialized_start=310
+  _MSGDELIVERY_REQUEST_WRITESETENTRY._serialized_end=357
+  _MSGDELIVERY_RESPONSE._serialized_start=366
+  _MSGDELIVERY_RESPONSE._serialized_end=660
+  _MSGDELIVERY_RESPONSE_WRITESETENTRY._serialized_start=310
+  _MSGDELIVERY_RESPONSE_WRITESETENTRY._serialized_end=357
+  _MSGDELIVERY_BATCH_REQUEST._serialized_start=662
+  _MSGDELIVERY_BATCH_REQUEST._serialized_end=733
+  _MSGDELIVERY_BATCH_RESPONSE._serialized_start=735
+  _MSGDELIVERY_BATCH_RESPONSE._serialized_end=809
+  _WRITE_SUMMARY._serialized_start=811
+  _WRITE_SUMMARY._serialized_end=875
+  _SYNC_REQUEST._serialized_start=877
+  _SYNC_REQUEST._serialized_end=940
+  _BANK._serialized_start=1087
+  _BANK._serialized_end=1307
 # @@protoc_insertion_point(module_scope)
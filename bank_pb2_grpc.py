@@ -20,6 +20,16 @@ class BankStub(object):
                 request_serializer=bank__pb2.MsgDelivery_request.SerializeToString,
                 response_deserializer=bank__pb2.MsgDelivery_response.FromString,
                 )
+        self.MsgDeliveryBatch = channel.unary_unary(
+                '/app.Bank/MsgDeliveryBatch',
+                request_serializer=bank__pb2.MsgDelivery_batch_request.SerializeToString,
+                response_deserializer=bank__pb2.MsgDelivery_batch_response.FromString,
+                )
+        self.Sync = channel.unary_stream(
+                '/app.Bank/Sync',
+                request_serializer=bank__pb2.Sync_request.SerializeToString,
+                response_deserializer=bank__pb2.MsgDelivery_request.FromString,
+                )
 
 
 class BankServicer(object):
@@ -33,6 +43,20 @@ class BankServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def MsgDeliveryBatch(self, request, context):
+        """Batch of MsgDelivery requests processed in order, one response per request
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Sync(self, request, context):
+        """Anti-entropy between branches, stream the writes missing from the summary of the requesting branch
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_BankServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -41,6 +65,16 @@ def add_BankServicer_to_server(servicer, server):
                     request_deserializer=bank__pb2.MsgDelivery_request.FromString,
                     response_serializer=bank__pb2.MsgDelivery_response.SerializeToString,
             ),
+            'MsgDeliveryBatch': grpc.unary_unary_rpc_method_handler(
+                    servicer.MsgDeliveryBatch,
+                    request_deserializer=bank__pb2.MsgDelivery_batch_request.FromString,
+                    response_serializer=bank__pb2.MsgDelivery_batch_response.SerializeToString,
+            ),
+            'Sync': grpc.unary_stream_rpc_method_handler(
+                    servicer.Sync,
+                    request_deserializer=bank__pb2.Sync_request.FromString,
+                    response_serializer=bank__pb2.MsgDelivery_request.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'app.Bank', rpc_method_handlers)
@@ -68,3 +102,37 @@ class Bank(object):
             bank__pb2.MsgDelivery_response.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def MsgDeliveryBatch(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/app.Bank/MsgDeliveryBatch',
+            bank__pb2.MsgDelivery_batch_request.SerializeToString,
+            bank__pb2.MsgDelivery_batch_response.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def Sync(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/app.Bank/Sync',
+            bank__pb2.Sync_request.SerializeToString,
+            bank__pb2.MsgDelivery_request.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
@@ -0,0 +1,191 @@
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+
+from Main import get_args, create_branch_input_data_collection, launch_branches, stop_branches, run_customers, create_socket_dir, remove_socket_dir, simulate, collect_profiles, get_customer_options
+from channel_pool import get_channel_pool
+from checker import run_check
+from profiler import SamplingProfiler, stop_and_write_profile
+from utilities import configure_logger, configure_logging
+
+logger = configure_logger("benchmark")
+
+def get_benchmark_args():
+    """
+    Benchmark options, the remaining arguments are passed to Main, e.g. --propagate-policy or --customer-workers
+    """
+    parser = argparse.ArgumentParser(description="Generate a synthetic workload, run it and report latency", allow_abbrev=False)
+    parser.add_argument("--branches", required=False, type=int, default=3, help="Number of branches")
+    parser.add_argument("--customers", required=False, type=int, default=10, help="Number of customers")
+    parser.add_argument("--events", required=False, type=int, default=20, help="Number of events per customer")
+    parser.add_argument("--read-ratio", required=False, type=float, default=0.5, help="Fraction of query events, the rest are split between deposit and withdraw")
+    parser.add_argument("--skew", required=False, type=float, default=0.0, help="Zipf exponent of the destination branch distribution, 0 is uniform")
+    parser.add_argument("--balance", required=False, type=int, default=10000, help="Initial balance of every branch")
+    parser.add_argument("--seed", required=False, type=int, default=0, help="Random seed of the workload")
+    parser.add_argument("--workload", required=False, type=str, default="benchmark_input.json", help="Generated input file name with json format")
+    parser.add_argument("--report", required=False, type=str, default="benchmark_report.json", help="Benchmark report file name with json format")
+    parser.add_argument("--generate-only", action="store_true", help="Only write the generated input file")
+    return parser.parse_known_args()
+
+def generate_workload(branches, customers, events, read_ratio=0.5, skew=0.0, balance=10000, seed=0):
+    """
+    Generate a workload in the input.json schema
+    Destination branches are drawn from a Zipf distribution with exponent skew, branch 1 is the hottest
+    """
+    rng = random.Random(seed)
+    branch_ids = list(range(1, branches + 1))
+    weights = [1 / rank ** skew for rank in branch_ids]
+    workload = []
+    for customer_id in range(1, customers + 1):
+        destinations = rng.choices(branch_ids, weights=weights, k=events)
+        customer_events = []
+        for dest in destinations:
+            if rng.random() < read_ratio:
+                customer_events.append({"interface": "query", "dest": dest})
+            else:
+                interface = rng.choice(["deposit", "withdraw"])
+                customer_events.append({"interface": interface, "money": rng.randint(1, 100), "dest": dest})
+        workload.append({"id": customer_id, "type": "customer", "events": customer_events})
+    for branch_id in branch_ids:
+        workload.append({"id": branch_id, "type": "branch", "balance": balance})
+    return workload
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not sorted_values:
+        return 0
+    rank = max(math.ceil(p * len(sorted_values) / 100), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def summarize_latencies(latencies):
+    """
+    Count, result breakdown and p50/p95/p99 latency in milliseconds of each operation type
+    Events sent in a batch have no latency of their own, their round trip is summarized under "batch".
+    """
+    operations = {}
+    for interface, latency, result in latencies:
+        operation = operations.setdefault(interface, {"count": 0, "latencies": [], "results": {}})
+        operation["count"] += 1
+        if latency is not None:
+            operation["latencies"].append(latency * 1000)
+        operation["results"][result] = operation["results"].get(result, 0) + 1
+    summary = {}
+    for interface, operation in sorted(operations.items()):
+        values = sorted(operation["latencies"])
+        summary[interface] = {"count": operation["count"], "results": operation["results"]}
+        if values:
+            summary[interface].update({
+                "latency_count": len(values),
+                "mean_ms": sum(values) / len(values),
+                "p50_ms": percentile(values, 50),
+                "p95_ms": percentile(values, 95),
+                "p99_ms": percentile(values, 99),
+                "max_ms": values[-1],
+            })
+    return summary
+
+def get_git_commit():
+    """
+    Current git commit of the tree, None if not available
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(workload_file, args):
+    """
+    Run the workload through the Main pipeline, return the elapsed seconds and the per-event latencies
+    """
+    socket_dir = create_socket_dir(args)
+    branches_data, customers_data = create_branch_input_data_collection(workload_file, socket_dir)
+    if args.transport == "sim":
+        latencies = []
+        profiler = SamplingProfiler(args.profile_interval)
+        if args.profile:
+            profiler.start()
+        start_time = time.perf_counter()
+        simulate(branches_data, customers_data, args, latencies)
+        elapsed = time.perf_counter() - start_time
+        if args.profile:
+            stop_and_write_profile(profiler, args.profile_dir, "simulation")
+        return elapsed, latencies
+    workers, stop_event, branches_bind_addresses = launch_branches(branches_data, args)
+    latencies = []
+    try:
+        start_time = time.perf_counter()
+        run_customers(customers_data, branches_bind_addresses, args.customer_workers, args.customer_batch_size, latencies, customer_options=get_customer_options(args))
+        elapsed = time.perf_counter() - start_time
+    finally:
+        get_channel_pool().close()
+        stop_branches(workers, stop_event, args.shutdown_timeout)
+        remove_socket_dir(args, socket_dir)
+    if args.profile:
+        collect_profiles(args, [branch["id"] for branch in branches_data])
+    return elapsed, latencies
+
+def main():
+    benchmark_args, main_argv = get_benchmark_args()
+    workload = generate_workload(
+        benchmark_args.branches,
+        benchmark_args.customers,
+        benchmark_args.events,
+        benchmark_args.read_ratio,
+        benchmark_args.skew,
+        benchmark_args.balance,
+        benchmark_args.seed
+    )
+    with open(benchmark_args.workload, "w") as file:
+        json.dump(workload, file)
+    logger.info("Workload has exported to file %s", benchmark_args.workload)
+    if benchmark_args.generate_only:
+        return
+
+    args = get_args(main_argv + ["--input", benchmark_args.workload])
+    configure_logging(args.log_level, not args.sync_logging)
+    elapsed, latencies = run_benchmark(benchmark_args.workload, args)
+    operations = sum(1 for interface, _, _ in latencies if interface != "batch")
+    report = {
+        "commit": get_git_commit(),
+        "workload": {
+            "branches": benchmark_args.branches,
+            "customers": benchmark_args.customers,
+            "events": benchmark_args.events,
+            "read_ratio": benchmark_args.read_ratio,
+            "skew": benchmark_args.skew,
+            "seed": benchmark_args.seed,
+        },
+        "options": {key: value for key, value in vars(args).items() if key not in ("input", "output")},
+        "elapsed_s": elapsed,
+        "throughput_ops": operations / elapsed if elapsed > 0 else 0,
+        "operations": summarize_latencies(latencies),
+    }
+    if args.op_log_dir is not None:
+        #verify the run from the branch operation logs, a run with violations fails the benchmark
+        report["consistency"] = run_check(benchmark_args.workload, args.op_log_dir)
+    with open(benchmark_args.report, "w") as file:
+        file.write(json.dumps(report, indent = 4))
+    logger.info(
+        "Benchmark report has exported to file %s, throughput %.1f ops/s",
+        benchmark_args.report,
+        report["throughput_ops"]
+    )
+    if report.get("consistency", {}).get("violations"):
+        logger.error("Benchmark run has %s consistency violations", report["consistency"]["violations"])
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
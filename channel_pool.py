@@ -0,0 +1,101 @@
+import grpc
+import os
+import threading
+import bank_pb2_grpc
+
+from utilities import configure_logger
+
+logger = configure_logger("ChannelPool")
+
+# keepalive pings keep the long-lived channels usable through idle periods
+KEEPALIVE_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+class ChannelPool:
+    """
+    One channel per bind address, shared by every stub of the process
+    Callers keep the stubs they get, e.g. a propagate round collects the stubs of every branch before sending,
+    so a channel is never closed while the pool is open, only by close_channel or close.
+    """
+
+    def __init__(self, max_channels=64, options=KEEPALIVE_OPTIONS):
+        # expected number of channels, the number of branches, more channels are logged as a sizing problem
+        self.max_channels = max_channels
+        # channel options used for every channel
+        self.options = options
+        # bind address -> (channel, stub)
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def get_stub(self, bind_address):
+        """
+        Return the stub of the bind address, the channel is created on first use and reused afterwards
+        """
+        with self.lock:
+            if bind_address in self.channels:
+                return self.channels[bind_address][1]
+            channel = grpc.insecure_channel(bind_address, options=self.options)
+            stub = bank_pb2_grpc.BankStub(channel)
+            self.channels[bind_address] = (channel, stub)
+            if len(self.channels) > self.max_channels:
+                logger.warning(
+                    "Channel pool has %s channels, more than its bound of %s, every channel stays open until the pool is closed",
+                    len(self.channels),
+                    self.max_channels
+                )
+            return stub
+
+    def is_healthy(self, bind_address, timeout=1.0):
+        """
+        Check if the channel to the bind address is connected, wait up to timeout seconds for it to be ready
+        """
+        self.get_stub(bind_address)
+        with self.lock:
+            channel = self.channels[bind_address][0]
+        try:
+            grpc.channel_ready_future(channel).result(timeout=timeout)
+        except grpc.FutureTimeoutError:
+            return False
+        return True
+
+    def close_channel(self, bind_address):
+        """
+        Close the channel to the bind address, next get_stub creates a new one
+        """
+        with self.lock:
+            entry = self.channels.pop(bind_address, None)
+        if entry is not None:
+            entry[0].close()
+
+    def close(self):
+        """
+        Close all of the channels
+        """
+        with self.lock:
+            entries = list(self.channels.values())
+            self.channels.clear()
+        for channel, _ in entries:
+            channel.close()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_channel_pool(max_channels=None):
+    """
+    Return the channel pool shared by the process, a forked branch process gets its own pool
+    max_channels is the number of branches the caller talks to, the pool bound grows to the largest one seen
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ChannelPool(max_channels or 64)
+            _pool_pid = os.getpid()
+        elif max_channels is not None and max_channels > _pool.max_channels:
+            _pool.max_channels = max_channels
+        return _pool
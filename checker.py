@@ -0,0 +1,353 @@
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+import bank_pb2
+from hash_ring import HashRing
+from op_log import COLUMNS, HEADER_PATTERN, QUERY, WRITE, get_op_log_file_name
+from utilities import configure_logger, configure_logging, get_json_data, iter_jsonl
+
+logger = configure_logger("checker")
+
+# max violating records reported per check
+MAX_EXAMPLES = 5
+
+def get_checker_args(argv=None):
+    parser = argparse.ArgumentParser(description="Verify the branch operation logs of a run against its input")
+    parser.add_argument("-i", "--input", required=False, type=str, default="input.json", help="Input file name of the run with json or JSON Lines format")
+    parser.add_argument("--op-log-dir", required=True, type=str, help="Directory of the branch_<id>.ops operation logs written with --op-log-dir")
+    parser.add_argument("--report", required=False, type=str, default=None, help="Report file name with json format, printed to stdout if not given")
+    parser.add_argument("--log-level", required=False, type=str, default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Log level")
+    return parser.parse_args(argv)
+
+def load_input(input_file):
+    """
+    Return the branch ids in input order and the number of deposit and withdraw events based on customer id
+    """
+    items = iter_jsonl(input_file) if input_file.endswith(".jsonl") else get_json_data(input_file)
+    branch_ids = []
+    customer_writes = {}
+    for item in items:
+        if item["type"] == "branch":
+            branch_ids.append(item["id"])
+        elif item["type"] == "customer":
+            writes = sum(1 for event in item["events"] if event["interface"] != "query")
+            customer_writes[item["id"]] = customer_writes.get(item["id"], 0) + writes
+    return branch_ids, customer_writes
+
+def read_op_log(file_name):
+    """
+    Return the header fields and the records of the operation log as an int64 array, one column per field
+    """
+    with open(file_name) as file:
+        match = HEADER_PATTERN.match(file.readline().strip())
+        if match is None:
+            raise ValueError("{} is not an operation log".format(file_name))
+        text = file.read()
+    #one flat parse of the whole file is faster than numpy.loadtxt, a malformed record fails the reshape
+    data = np.fromstring(text.rstrip("\n").replace("\n", ","), dtype=np.int64, sep=",") if text else np.empty(0, dtype=np.int64)
+    data = data.reshape(-1, len(COLUMNS))
+    return int(match.group(1)), int(match.group(2)), int(match.group(3)), data
+
+def load_op_logs(op_log_dir, branch_ids):
+    """
+    Load the operation logs of the branches, return the initial balance of each branch, the replication factor
+    and the records as a dict of column arrays. The records of a branch are contiguous and in apply order,
+    "branch" is the index of the branch in branch_ids and "position" the record number in its log.
+    """
+    balances = np.zeros(len(branch_ids), dtype=np.int64)
+    replication_factor = 0
+    blocks = []
+    for index, branch_id in enumerate(branch_ids):
+        header_id, balance, replication_factor, data = read_op_log(get_op_log_file_name(op_log_dir, branch_id))
+        if header_id != branch_id:
+            raise ValueError("operation log of branch {} has the header of branch {}".format(branch_id, header_id))
+        balances[index] = balance
+        blocks.append((index, data))
+    data = np.concatenate([block for _, block in blocks]) if blocks else np.empty((0, len(COLUMNS)), dtype=np.int64)
+    #contiguous columns, strided views of the rows would slow down every check
+    records = dict(zip(COLUMNS, np.ascontiguousarray(data.T)))
+    records["branch"] = np.concatenate([np.full(len(block), index, dtype=np.int64) for index, block in blocks] or [np.empty(0, dtype=np.int64)])
+    records["position"] = np.concatenate([np.arange(len(block), dtype=np.int64) for _, block in blocks] or [np.empty(0, dtype=np.int64)])
+    return balances, replication_factor, records
+
+def segment_starts(*keys):
+    """
+    Boolean mask of the first element of every run of equal keys, the arrays must be sorted by the keys
+    """
+    starts = np.ones(len(keys[0]), dtype=bool)
+    if len(starts):
+        changed = np.zeros(len(starts) - 1, dtype=bool)
+        for key in keys:
+            changed |= key[1:] != key[:-1]
+        starts[1:] = changed
+    return starts
+
+def segment_cumsum(values, starts):
+    """
+    Inclusive prefix sums of values restarting at every start
+    """
+    totals = np.cumsum(values)
+    start_indices = np.flatnonzero(starts)
+    lengths = np.diff(np.append(start_indices, len(values)))
+    return totals - np.repeat(totals[start_indices] - values[start_indices], lengths)
+
+def group_order(key):
+    """
+    Indices of the records sorted by key, the sort is stable so the records of a group stay in apply order
+    """
+    return np.argsort(key, kind="stable")
+
+def get_examples(records, mask, branch_ids, **extra):
+    """
+    The first MAX_EXAMPLES violating records as dicts, extra columns are arrays aligned with the records
+    """
+    indices = np.flatnonzero(mask)[:MAX_EXAMPLES]
+    examples = []
+    for index in indices:
+        example = {"branch": branch_ids[records["branch"][index]]}
+        example.update({name: int(records[name][index]) for name in COLUMNS + ("position",)})
+        example.update({name: int(values[index]) for name, values in extra.items()})
+        examples.append(example)
+    return examples
+
+def check_result(records, mask, branch_ids, description, **extra):
+    return {"description": description, "violations": int(np.count_nonzero(mask)), "examples": get_examples(records, mask, branch_ids, **extra)}
+
+def check(branch_ids, customer_writes, balances, replication_factor, records):
+    """
+    Replay the operation logs and return the results of every check based on check name
+    Every check is a handful of sorts and prefix sums over the whole log, there is no per-record Python loop.
+    """
+    kind = records["kind"]
+    customer = records["customer"]
+    branch = records["branch"]
+    branch_count = len(branch_ids)
+    is_write = kind == WRITE
+    is_query = kind == QUERY
+    success = records["result"] == bank_pb2.Result.success
+    withdraw = records["operation"] == bank_pb2.Operation.withdraw
+    # index of the origin branch, writes at their origin carry the customer request seq
+    branch_index = {branch_id: index for index, branch_id in enumerate(branch_ids)}
+    branch_id_array = np.asarray(branch_ids, dtype=np.int64)
+    branch_sorter = np.argsort(branch_id_array)
+    origin = branch_sorter[np.searchsorted(branch_id_array, records["origin"], sorter=branch_sorter).clip(0, branch_count - 1)]
+    at_origin = is_write & (origin == branch)
+    # dense customer index
+    customer_ids, customer_index = np.unique(customer, return_inverse=True)
+    customer_count = len(customer_ids)
+    # records in (branch, customer) groups, records are loaded in branch and apply order
+    session_key = branch * customer_count + customer_index
+    by_session = group_order(session_key)
+    session_starts = segment_starts(session_key[by_session])
+    results = {}
+
+    # balance replay, every account starts with the initial branch balance, the shared branch balance without partial replication
+    partial = 0 < replication_factor < branch_count
+    signed = np.where(is_write & success, np.where(withdraw, -records["amount"], records["amount"]), 0)
+    if partial:
+        replay_order, replay_starts = by_session, session_starts
+    else:
+        replay_order, replay_starts = np.arange(len(kind)), segment_starts(branch)
+    expected = np.empty(len(kind), dtype=np.int64)
+    expected[replay_order] = balances[branch[replay_order]] + segment_cumsum(signed[replay_order], replay_starts)
+    results["balance"] = check_result(
+        records,
+        expected != records["balance"],
+        branch_ids,
+        "balance logged by the branch differs from the replay of its log",
+        expected_balance=expected
+    )
+    results["overdraft"] = check_result(
+        records,
+        is_write & withdraw & success & (expected < 0),
+        branch_ids,
+        "successful withdraw left a negative balance",
+        expected_balance=expected
+    )
+    results["spurious_failure"] = check_result(
+        records,
+        is_write & withdraw & ~success & (records["amount"] <= expected),
+        branch_ids,
+        "withdraw failed although the balance covered it",
+        expected_balance=expected
+    )
+    results["divergent_result"] = check_result(
+        records,
+        is_write & ~at_origin & ~success,
+        branch_ids,
+        "write succeeded at its origin but not at the replica"
+    )
+
+    # exactly once, a customer request is applied once at its origin, the checks below count only its first apply
+    seq_range = int(records["seq"].max()) + 1 if len(kind) else 1
+    request_key = customer_index * seq_range + records["seq"]
+    origin_records = np.flatnonzero(at_origin & (records["seq"] > 0))
+    order = origin_records[group_order(request_key[origin_records])]
+    duplicated = np.zeros(len(kind), dtype=bool)
+    duplicated[order[1:][request_key[order][1:] == request_key[order][:-1]]] = True
+    results["duplicate_request"] = check_result(records, duplicated, branch_ids, "customer request applied more than once")
+    at_origin &= ~duplicated
+
+    # replica groups and the writes every replica of a customer must have applied
+    if partial:
+        ring = HashRing(branch_ids)
+        replicas = np.zeros((customer_count, branch_count), dtype=bool)
+        for index, customer_id in enumerate(customer_ids.tolist()):
+            replicas[index, [branch_index[node] for node in ring.get_nodes(customer_id, replication_factor)]] = True
+    else:
+        replicas = np.ones((customer_count, branch_count), dtype=bool)
+    origin_writes = np.bincount(customer_index[at_origin], minlength=customer_count)
+    applied = np.bincount(customer_index[is_write] * branch_count + branch[is_write], minlength=customer_count * branch_count).reshape(customer_count, branch_count)
+    missing = replicas & (applied < origin_writes[:, None])
+    misplaced = ~replicas & (applied > 0)
+    results["missing_writes"] = {
+        "description": "replica has not applied every write of the customer",
+        "violations": int(np.count_nonzero(missing)),
+        "examples": [
+            {"branch": branch_ids[b], "customer": int(customer_ids[c]), "applied": int(applied[c, b]), "expected": int(origin_writes[c])}
+            for c, b in list(zip(*np.nonzero(missing)))[:MAX_EXAMPLES]
+        ],
+    }
+    results["misplaced_writes"] = {
+        "description": "branch applied writes of a customer it does not replicate",
+        "violations": int(np.count_nonzero(misplaced)),
+        "examples": [
+            {"branch": branch_ids[b], "customer": int(customer_ids[c]), "applied": int(applied[c, b])}
+            for c, b in list(zip(*np.nonzero(misplaced)))[:MAX_EXAMPLES]
+        ],
+    }
+
+    # final balance of every account against the initial balance plus every write that succeeded at its origin
+    last = np.empty(len(replay_order), dtype=bool)
+    last[:-1] = replay_starts[1:]
+    last[-1:] = True
+    final_records = replay_order[last]
+    origin_totals = np.zeros(customer_count, dtype=np.int64)
+    np.add.at(origin_totals, customer_index[at_origin], signed[at_origin])
+    if partial:
+        expected_final = balances[branch[final_records]] + origin_totals[customer_index[final_records]]
+    else:
+        expected_final = balances[branch[final_records]] + origin_totals.sum()
+    diverged = np.zeros(len(kind), dtype=bool)
+    diverged[final_records[expected[final_records] != expected_final]] = True
+    final_expected = np.zeros(len(kind), dtype=np.int64)
+    final_expected[final_records] = expected_final
+    results["final_balance"] = check_result(
+        records,
+        diverged,
+        branch_ids,
+        "final balance differs from the initial balance plus every write succeeded at its origin",
+        expected_balance=final_expected
+    )
+
+    # monotonic writes, the writes of a customer from an origin are applied in origin order without gaps or duplicates
+    writes = np.flatnonzero(is_write)
+    order = writes[group_order(session_key[writes] * branch_count + origin[writes])]
+    continued = ~segment_starts(session_key[order], origin[order])
+    out_of_order = np.zeros(len(kind), dtype=bool)
+    out_of_order[order[1:][continued[1:] & (np.diff(records["origin_count"][order]) != 1)]] = True
+    results["write_order"] = check_result(
+        records,
+        out_of_order,
+        branch_ids,
+        "write applied out of origin order, after a gap or twice"
+    )
+    # session order, a write is never applied after a write depending on more of the customer writes
+    order = by_session[is_write[by_session]]
+    continued = ~segment_starts(session_key[order])
+    out_of_session = np.zeros(len(kind), dtype=bool)
+    out_of_session[order[1:][continued[1:] & (np.diff(records["session_index"][order]) < 0)]] = True
+    results["session_order"] = check_result(
+        records,
+        out_of_session,
+        branch_ids,
+        "write applied after a write which depends on it"
+    )
+
+    # the input bounds the number of writes of every customer
+    input_writes = np.array([customer_writes.get(int(customer_id), 0) for customer_id in customer_ids], dtype=np.int64)
+    unexpected = np.flatnonzero(origin_writes > input_writes)
+    results["unexpected_writes"] = {
+        "description": "customer has more writes applied than write events in the input",
+        "violations": len(unexpected),
+        "examples": [
+            {"customer": int(customer_ids[c]), "applied": int(origin_writes[c]), "input": int(input_writes[c])}
+            for c in unexpected[:MAX_EXAMPLES]
+        ],
+    }
+
+    # read your writes, a successful query sees every write of its session which succeeded before the query was sent
+    # writes the branch applied before the query, counted in the (branch, customer) groups in apply order
+    seen_writes = np.empty(len(kind), dtype=np.int64)
+    seen_writes[by_session] = segment_cumsum(is_write[by_session].astype(np.int64), session_starts)
+    # writes the session sent before the query, counted in the customer groups in request order
+    successful_query = is_query & success
+    requests = np.flatnonzero(successful_query | (at_origin & (records["seq"] > 0)))
+    order = requests[np.argsort(request_key[requests])]
+    required_writes = np.zeros(len(kind), dtype=np.int64)
+    required_writes[order] = segment_cumsum(
+        (~successful_query[order]).astype(np.int64),
+        segment_starts(customer_index[order])
+    )
+    stale = successful_query & (seen_writes < required_writes)
+    results["read_your_writes"] = check_result(
+        records,
+        stale,
+        branch_ids,
+        "query missed a write of its session which succeeded before it",
+        required_writes=required_writes,
+        seen_writes=seen_writes
+    )
+    return results
+
+def run_check(input_file, op_log_dir):
+    """
+    Check the operation logs of a run, return the report
+    """
+    start_time = time.perf_counter()
+    branch_ids, customer_writes = load_input(input_file)
+    balances, replication_factor, records = load_op_logs(op_log_dir, branch_ids)
+    load_seconds = time.perf_counter() - start_time
+    results = check(branch_ids, customer_writes, balances, replication_factor, records)
+    violations = sum(result["violations"] for result in results.values())
+    report = {
+        "records": len(records["kind"]),
+        "writes": int(np.count_nonzero(records["kind"] == WRITE)),
+        "queries": int(np.count_nonzero(records["kind"] == QUERY)),
+        "branches": len(branch_ids),
+        "replication_factor": replication_factor,
+        "violations": violations,
+        "checks": results,
+        "load_s": load_seconds,
+        "elapsed_s": time.perf_counter() - start_time,
+    }
+    logger.info(
+        "Checked %s operations of %s branches in %.2fs, %s violations",
+        report["records"],
+        report["branches"],
+        report["elapsed_s"],
+        violations
+    )
+    for name, result in results.items():
+        if result["violations"]:
+            logger.warning("Check %s failed %s times: %s", name, result["violations"], result["description"])
+    return report
+
+def main():
+    args = get_checker_args()
+    configure_logging(args.log_level)
+    report = run_check(args.input, args.op_log_dir)
+    if args.report is None:
+        print(json.dumps(report, indent = 4))
+    else:
+        with open(args.report, "w") as file:
+            file.write(json.dumps(report, indent = 4))
+        logger.info("Checker report has exported to file %s", args.report)
+    sys.exit(1 if report["violations"] else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent import futures
+
+class DedupCache:
+    """
+    LRU cache of the responses based on request id, entries expire ttl seconds after they are completed
+    A request id seen while its first request is still processing waits for that response instead of running twice.
+    """
+
+    def __init__(self, max_entries=10000, ttl=60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # request id -> (future of the response, expiry time on the monotonic clock), ordered by last use
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def begin(self, request_id):
+        """
+        Return (future, owner), the owner processes the request and calls complete or abort,
+        other callers wait for the future
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(request_id)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(request_id)
+                return entry[0], False
+            future = futures.Future()
+            # in-flight entries do not expire, the expiry is set on complete
+            self.entries[request_id] = (future, float("inf"))
+            self.entries.move_to_end(request_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return future, True
+
+    def complete(self, request_id, future, response):
+        with self.lock:
+            if request_id in self.entries:
+                self.entries[request_id] = (future, time.monotonic() + self.ttl)
+        future.set_result(response)
+
+    def abort(self, request_id, future, response=None, exception=None):
+        """
+        Drop the entry so the next request with the id runs again, callers waiting for the future get the
+        response or the exception
+        """
+        with self.lock:
+            if request_id in self.entries and self.entries[request_id][0] is future:
+                del self.entries[request_id]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(response)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,35 @@
+import bisect
+import hashlib
+
+def hash_key(key):
+    """
+    Stable 64-bit hash of the key, the same in every process unlike the builtin hash of str
+    """
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], "big")
+
+class HashRing:
+    """
+    Consistent hash ring, every node owns virtual_nodes points on the ring
+    Adding or removing a node only moves the keys next to its points, the other keys keep their nodes.
+    """
+
+    def __init__(self, nodes, virtual_nodes=64):
+        self.nodes = list(nodes)
+        # sorted (point, node) of every virtual node
+        self.ring = sorted((hash_key("{}#{}".format(node, index)), node) for node in self.nodes for index in range(virtual_nodes))
+        self.points = [point for point, _ in self.ring]
+
+    def get_nodes(self, key, count):
+        """
+        Return the first count distinct nodes clockwise from the key, the first one is the primary node of the key
+        """
+        count = min(count, len(self.nodes))
+        start = bisect.bisect(self.points, hash_key(key))
+        nodes = []
+        for offset in range(len(self.ring)):
+            if len(nodes) >= count:
+                break
+            node = self.ring[(start + offset) % len(self.ring)][1]
+            if node not in nodes:
+                nodes.append(node)
+        return nodes
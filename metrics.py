@@ -0,0 +1,126 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+# latency buckets in seconds, 100us to 10s
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# size buckets in bytes, 1B to 1MB, the small ones resolve version vectors of a few branches
+SIZE_BUCKETS = [2 ** exponent for exponent in range(0, 21)]
+
+class Counter:
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        # upper bounds of the buckets, values above the last bound go to the overflow bucket
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def snapshot(self):
+        with self.lock:
+            buckets = {str(bound): count for bound, count in zip(self.buckets, self.counts)}
+            buckets["+Inf"] = self.counts[-1]
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else 0,
+                "min": self.min,
+                "max": self.max,
+                "buckets": buckets,
+            }
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        # (name, labels) -> Counter or Histogram
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get_metric(self, name, labels, factory):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(key, factory())
+        return metric
+
+    def counter(self, name, **labels):
+        """
+        Return the counter of the name and labels, created on first use
+        """
+        return self.get_metric(name, labels, Counter)
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS, **labels):
+        """
+        Return the histogram of the name and labels, created on first use
+        """
+        return self.get_metric(name, labels, lambda: Histogram(buckets))
+
+    def snapshot(self):
+        """
+        Return all of the metrics as a dict, metric name with labels as key, e.g. propagate_rtt_seconds{branch=2}
+        """
+        with self.lock:
+            items = list(self.metrics.items())
+        snapshot = {}
+        for (name, labels), metric in sorted(items, key=lambda item: item[0]):
+            if labels:
+                name = "{}{{{}}}".format(name, ",".join("{}={}".format(key, value) for key, value in labels))
+            snapshot[name] = metric.snapshot()
+        return snapshot
+
+    def dump(self, file_name, extra=None):
+        """
+        Write the snapshot to the json file, the file is replaced atomically so readers never see a partial dump
+        """
+        data = {"timestamp": time.time(), "metrics": self.snapshot()}
+        if extra:
+            data.update(extra)
+        temp_file_name = "{}.tmp".format(file_name)
+        with open(temp_file_name, "w") as file:
+            file.write(json.dumps(data, indent = 4))
+        os.replace(temp_file_name, file_name)
+
+
+@contextmanager
+def timed_lock(lock, histogram):
+    """
+    Acquire the lock and record the time spent waiting for it
+    """
+    start_time = time.perf_counter()
+    with lock:
+        histogram.observe(time.perf_counter() - start_time)
+        yield
@@ -0,0 +1,59 @@
+import os
+import re
+import threading
+
+# record kinds of the operation log
+WRITE = 0
+QUERY = 1
+# columns of the operation log records, every column is an integer
+# origin_count is the number of writes of the customer from the origin branch including this one
+# session_index is the number of writes of the customer the write depends on including itself, for queries
+# the number of writes of the customer the branch has applied
+# seq is the sequence number of the customer request id, 0 for propagated writes
+COLUMNS = ("kind", "customer", "origin", "origin_count", "session_index", "operation", "amount", "result", "balance", "seq")
+HEADER_PATTERN = re.compile(r"^# branch=(-?\d+) balance=(-?\d+) replication_factor=(\d+)$")
+
+def get_op_log_file_name(op_log_dir, branch_id):
+    return os.path.join(op_log_dir, "branch_{}.ops".format(branch_id))
+
+def get_request_seq(request_id):
+    """
+    Sequence number of the customer request id "<session id>-<seq>", 0 if the request has no id
+    """
+    if not request_id:
+        return 0
+    return int(request_id.rsplit("-", 1)[1])
+
+
+class OperationLog:
+    """
+    Operations applied by one branch for offline verification, one line of comma separated integers per
+    operation in the order the branch applied them. The header line is a comment with the branch id, the
+    initial balance and the replication factor (0 replicates to every branch), so numpy.loadtxt reads the
+    records as they are.
+    Records are buffered and written in chunks, the log is not durable.
+    """
+
+    def __init__(self, file_name, branch_id, balance, replication_factor, buffer_size=4096):
+        self.file = open(file_name, "w")
+        self.file.write("# branch={} balance={} replication_factor={}\n".format(branch_id, balance, replication_factor))
+        # formatted records waiting to be written
+        self.buffer = []
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+
+    def record(self, kind, customer, origin, origin_count, session_index, operation, amount, result, balance, seq=0):
+        line = "%d,%d,%d,%d,%d,%d,%d,%d,%d,%d\n" % (
+            kind, customer, origin, origin_count, session_index, operation, amount, result, balance, seq
+        )
+        with self.lock:
+            self.buffer.append(line)
+            if len(self.buffer) >= self.buffer_size:
+                self.file.write("".join(self.buffer))
+                self.buffer = []
+
+    def close(self):
+        with self.lock:
+            self.file.write("".join(self.buffer))
+            self.buffer = []
+            self.file.close()
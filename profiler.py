@@ -0,0 +1,117 @@
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+from utilities import configure_logger
+
+logger = configure_logger("Profiler")
+
+class SamplingProfiler:
+    """
+    Statistical profiler, a background thread samples the stack of every thread of the process every interval seconds
+    Unlike cProfile it sees the gRPC worker threads and costs the same whatever the call rate is.
+    Stacks are written in the collapsed format of flamegraph.pl and speedscope, one "frame;frame;frame count" per line.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        # collapsed stack -> number of samples
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started_at = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+
+    def is_running(self):
+        return self.thread is not None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stacks.clear()
+            self.samples = 0
+            self.started_at = time.monotonic()
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.sample, name="Profiler", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            if self.thread is None:
+                return
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    def sample(self):
+        own_thread = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{}:{}:{}".format(os.path.basename(code.co_filename), code.co_name, code.co_firstlineno))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write_collapsed(self, file_name):
+        """
+        Write the sampled stacks to the file, most frequent first
+        """
+        with open(file_name, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write("{} {}\n".format(stack, count))
+        logger.info(
+            "Profile of %s samples over %.1fs has exported to file %s",
+            self.samples,
+            time.monotonic() - self.started_at,
+            file_name
+        )
+
+
+def get_profile_file_name(profile_dir, name):
+    return os.path.join(profile_dir, "{}.collapsed".format(name))
+
+def install_profile_signal_handler(profiler, profile_dir, name, signum=signal.SIGUSR1):
+    """
+    Toggle the profiler with the signal, e.g. kill -USR1 <branch pid> starts it and the next one stops it
+    and writes profile_dir/<name>.collapsed. Must be called on the main thread of the process.
+    """
+    def toggle(signum, frame):
+        #the handler runs on the main thread, stop joins the sampler so it is done on a helper thread
+        if profiler.is_running():
+            threading.Thread(target=stop_and_write_profile, args=(profiler, profile_dir, name), daemon=True).start()
+        else:
+            logger.info("Profiling %s started", name)
+            profiler.start()
+    signal.signal(signum, toggle)
+
+def stop_and_write_profile(profiler, profile_dir, name):
+    """
+    Stop the profiler and write its stacks to profile_dir/<name>.collapsed, return the file name
+    """
+    profiler.stop()
+    os.makedirs(profile_dir, exist_ok=True)
+    file_name = get_profile_file_name(profile_dir, name)
+    profiler.write_collapsed(file_name)
+    return file_name
+
+def merge_collapsed(file_names, output_file_name):
+    """
+    Merge the collapsed stack files into one, every stack is rooted at the name of its file, e.g. branch_1
+    """
+    with open(output_file_name, "w") as output:
+        for file_name in file_names:
+            root = os.path.splitext(os.path.basename(file_name))[0]
+            with open(file_name) as file:
+                for line in file:
+                    output.write("{};{}".format(root, line))
+    return output_file_name
@@ -0,0 +1,204 @@
+import grpc
+import random
+import threading
+import time
+import bank_pb2
+
+from concurrent import futures
+from op_log import get_request_seq
+from utilities import configure_logger
+
+logger = configure_logger("Simulation")
+
+def get_message_key(request):
+    """
+    Identity of the message independent of the thread and the time it is sent on
+    Customer requests are keyed by customer and request sequence number, propagated writes by customer, origin
+    branch and origin write count, anti-entropy requests by their content.
+    """
+    if isinstance(request, bank_pb2.Sync_request):
+        return "sync:{}".format(request.SerializeToString(deterministic=True).hex())
+    if isinstance(request, bank_pb2.MsgDelivery_batch_request):
+        return "|".join(get_message_key(item) for item in request.requests)
+    if request.source_type == bank_pb2.Source.customer:
+        return "customer:{}:{}".format(request.id, get_request_seq(request.request_id))
+    return "write:{}:{}:{}".format(request.id, request.last_write_branch, request.write_set.get(request.last_write_branch, 0))
+
+
+class SimulatedRpcError(grpc.RpcError):
+
+    def __init__(self, code, details=""):
+        super().__init__(details)
+        # grpc.StatusCode of the simulated failure
+        self.status_code = code
+        self.status_details = details
+
+    def code(self):
+        return self.status_code
+
+    def details(self):
+        return self.status_details
+
+
+class SimulatedContext:
+    """
+    Minimal stand-in for grpc.ServicerContext, only the deadline is simulated
+    """
+
+    def __init__(self, timeout=None):
+        # absolute deadline on the monotonic clock, None means no deadline
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+
+    def time_remaining(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
+
+    def is_active(self):
+        return self.deadline is None or time.monotonic() < self.deadline
+
+    def abort(self, code, details):
+        raise SimulatedRpcError(code, details)
+
+
+class SimulatedMethod:
+
+    def __init__(self, network, bind_address, name):
+        self.network = network
+        self.bind_address = bind_address
+        # servicer method name, e.g. MsgDelivery
+        self.name = name
+
+    def __call__(self, request, timeout=None):
+        """
+        Deliver the request to the registered branch on the calling thread, same semantics as a blocking stub call
+        """
+        return self.network.deliver(self.bind_address, self.name, request, timeout)
+
+    def future(self, request, timeout=None):
+        """
+        Deliver the request on the network executor, return a future of the response
+        """
+        return self.network.executor.submit(self.network.deliver, self.bind_address, self.name, request, timeout)
+
+
+class SimulatedStub:
+
+    def __init__(self, network, bind_address):
+        self.MsgDelivery = SimulatedMethod(network, bind_address, "MsgDelivery")
+        self.MsgDeliveryBatch = SimulatedMethod(network, bind_address, "MsgDeliveryBatch")
+        self.Sync = SimulatedMethod(network, bind_address, "Sync")
+
+
+class SimulatedNetwork:
+    """
+    In-process transport, stubs call the Branch servicer methods directly instead of going through gRPC
+    Requests are passed by reference without serialization, branches treat received requests as read-only.
+    Latency and loss of a delivery are drawn from a generator seeded by (seed, destination, message, attempt),
+    so a message gets the same fate in every run with the same seed, whichever thread sends it and whenever.
+    The attempt counts the failed deliveries of the message to the destination, so a resent message gets a new draw.
+    Anti-entropy rounds and propagate batches depend on timing, so runs using them send different messages.
+    Only branch to branch messages are lost, so a run without customer retries still completes every session.
+    """
+
+    def __init__(self, seed=0, latency=0.0, jitter=0.0, loss=0.0, max_workers=32):
+        self.seed = seed
+        # mean one-way latency in seconds added to each delivery
+        self.latency = latency
+        # max random latency in seconds added on top of latency
+        self.jitter = jitter
+        # probability a branch to branch message is dropped
+        self.loss = loss
+        # bind address -> Branch servicer
+        self.branches = {}
+        # (destination, message key) -> number of failed deliveries, dropped once the message is delivered
+        self.attempts = {}
+        # bind address -> stub, stubs are stateless so one per branch is enough
+        self.stubs = {}
+        self.lock = threading.Lock()
+        # runs future() deliveries, e.g. concurrent propagate requests
+        self.executor = futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="Simulation")
+
+    def register(self, bind_address, branch):
+        """
+        Register the branch servicer under its bind address
+        """
+        with self.lock:
+            self.branches[bind_address] = branch
+
+    def get_stub(self, bind_address):
+        """
+        Return the stub of the bind address, same interface as ChannelPool.get_stub
+        """
+        with self.lock:
+            if bind_address not in self.stubs:
+                self.stubs[bind_address] = SimulatedStub(self, bind_address)
+            return self.stubs[bind_address]
+
+    def is_healthy(self, bind_address, timeout=1.0):
+        return bind_address in self.branches
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def is_lossy(self, request):
+        """
+        Check if the request may be dropped, customer requests are always delivered
+        """
+        if isinstance(request, bank_pb2.Sync_request):
+            return True
+        if isinstance(request, bank_pb2.MsgDelivery_batch_request):
+            return bool(request.requests) and request.requests[0].source_type == bank_pb2.Source.branch
+        return request.source_type == bank_pb2.Source.branch
+
+    def draw(self, bind_address, request, timeout=None):
+        """
+        Draw the delay and the drop decision of the delivery to the branch
+        """
+        key = (bind_address, get_message_key(request))
+        with self.lock:
+            attempt = self.attempts.get(key, 0)
+        generator = random.Random("{}:{}:{}:{}".format(self.seed, bind_address, key[1], attempt))
+        delay = self.latency + (generator.random() * self.jitter if self.jitter > 0 else 0)
+        dropped = self.loss > 0 and self.is_lossy(request) and generator.random() < self.loss
+        with self.lock:
+            if dropped or (timeout is not None and delay >= timeout):
+                self.attempts[key] = attempt + 1
+            else:
+                self.attempts.pop(key, None)
+        return delay, dropped
+
+    def deliver_late(self, branch, method_name, request, delay):
+        """
+        Deliver the request of a caller which already gave up on its deadline, the response is discarded
+        """
+        time.sleep(delay)
+        response = getattr(branch, method_name)(request, SimulatedContext())
+        if method_name == "Sync":
+            list(response)
+
+    def deliver(self, bind_address, method_name, request, timeout=None):
+        """
+        Simulate the delay and loss, then call the servicer method of the branch
+        Lost messages and deliveries slower than the deadline raise SimulatedRpcError like a failed gRPC call.
+        """
+        branch = self.branches.get(bind_address)
+        if branch is None:
+            raise SimulatedRpcError(grpc.StatusCode.UNAVAILABLE, "no branch on {}".format(bind_address))
+        delay, dropped = self.draw(bind_address, request, timeout)
+        if timeout is not None and delay >= timeout:
+            #like a real deadline the caller gives up, but the request still reaches the branch late
+            if not dropped:
+                self.executor.submit(self.deliver_late, branch, method_name, request, delay)
+            time.sleep(timeout)
+            raise SimulatedRpcError(grpc.StatusCode.DEADLINE_EXCEEDED, "simulated latency exceeded the deadline")
+        if delay > 0:
+            time.sleep(delay)
+        if dropped:
+            raise SimulatedRpcError(grpc.StatusCode.UNAVAILABLE, "simulated message loss")
+        context = SimulatedContext(None if timeout is None else timeout - delay)
+        response = getattr(branch, method_name)(request, context)
+        if method_name == "Sync":
+            #server streaming, collect the stream before returning like a completed call
+            return list(response)
+        return response
@@ -3,6 +3,11 @@ import socketserver
 import sys
 import json
 import logging
+import logging.handlers
+import os
+import queue
+import threading
+import atexit
 
 def get_operation(operation):
     if operation.lower() == "query":
@@ -27,6 +32,8 @@ def get_result_name(result):
         return "failure"
     if result == bank_pb2.Result.error:
         return "error"
+    if result == bank_pb2.Result.busy:
+        return "busy"
 
 def get_source_type_name(source_type):
     if source_type == bank_pb2.Source.customer:
@@ -39,16 +46,108 @@ def get_system_free_tcp_port():
         available_port = server.server_address[1]
     return available_port
 
+def get_unix_socket_address(socket_dir, branch_id):
+    """
+    gRPC address of the branch unix domain socket, the path is owned by the branch so there is no port race
+    """
+    return "unix:{}".format(os.path.join(os.path.abspath(socket_dir), "branch_{}.sock".format(branch_id)))
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(process)d - %(levelname)s - %(message)s'
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler feeding the log listener thread of the process
+    Records are queued unformatted, the message is formatted and written to stdout on the listener thread
+    """
+    def prepare(self, record):
+        if record.exc_info:
+            return super().prepare(record)
+        return record
+
+    def emit(self, record):
+        if _log_listener_pid != os.getpid():
+            start_log_listener()
+        super().emit(record)
+
+_loggers = []
+_log_level = logging.INFO
+_log_listener = None
+_log_listener_pid = None
+_log_listener_lock = threading.Lock()
+_queue_handler = BackgroundQueueHandler(queue.SimpleQueue())
+_stream_handler = logging.StreamHandler(sys.stdout)
+_stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+def start_log_listener():
+    """
+    Start the log listener thread of the process, a forked process starts its own listener with a new queue
+    """
+    global _log_listener, _log_listener_pid
+    with _log_listener_lock:
+        if _log_listener_pid == os.getpid():
+            return
+        _queue_handler.queue = queue.SimpleQueue()
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        _log_listener = logging.handlers.QueueListener(_queue_handler.queue, handler)
+        _log_listener.start()
+        _log_listener_pid = os.getpid()
+
+def stop_log_listener():
+    """
+    Write out the queued records and stop the log listener thread of the process
+    """
+    global _log_listener, _log_listener_pid
+    with _log_listener_lock:
+        if _log_listener is None or _log_listener_pid != os.getpid():
+            return
+        _log_listener.stop()
+        _log_listener = None
+        _log_listener_pid = None
+
+def _reset_log_listener_after_fork():
+    global _log_listener, _log_listener_pid, _log_listener_lock
+    _log_listener = None
+    _log_listener_pid = None
+    _log_listener_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_log_listener_after_fork)
+atexit.register(stop_log_listener)
+
+def configure_logging(level="INFO", async_logging=True):
+    """
+    Set the level of all of the loggers, async_logging writes the records on the listener thread instead of the caller thread
+    """
+    global _log_level
+    _log_level = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+    handler = _queue_handler if async_logging else _stream_handler
+    for logger in _loggers:
+        logger.setLevel(_log_level)
+        for old_handler in list(logger.handlers):
+            if old_handler in (_queue_handler, _stream_handler):
+                logger.removeHandler(old_handler)
+        logger.addHandler(handler)
+    if not async_logging:
+        stop_log_listener()
+
 def configure_logger(name):
     logger = logging.getLogger(name)
-    handler = logging.StreamHandler(sys.stdout)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(process)d - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    logger.setLevel(logging.INFO)
+    logger.addHandler(_queue_handler)
+    logger.setLevel(_log_level)
+    _loggers.append(logger)
     return logger
 
 def get_json_data(json_file):
     with open(json_file, 'r') as file:
         json_data = json.load(file)
-    return json_data
\ No newline at end of file
+    return json_data
+
+def iter_jsonl(jsonl_file):
+    """
+    Yield the json object of each non-empty line of the JSON Lines file
+    """
+    with open(jsonl_file, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
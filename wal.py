@@ -0,0 +1,194 @@
+import json
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+from utilities import configure_logger
+
+logger = configure_logger("WAL")
+
+# record header, payload length and crc32 of the payload
+HEADER = struct.Struct("<II")
+SEGMENT_PATTERN = re.compile(r"^wal-(\d+)\.log$")
+SNAPSHOT_FILE_NAME = "snapshot.json"
+
+def get_segment_file_name(directory, segment):
+    return os.path.join(directory, "wal-{:08d}.log".format(segment))
+
+def list_segments(directory):
+    """
+    Segment numbers of the WAL files in the directory, in order
+    """
+    segments = []
+    for file_name in os.listdir(directory):
+        match = SEGMENT_PATTERN.match(file_name)
+        if match:
+            segments.append(int(match.group(1)))
+    return sorted(segments)
+
+def read_segments(directory, first_segment=0):
+    """
+    Yield the payload of every record in the segments from first_segment on, in append order
+    A torn record at the end of a segment, e.g. the process died during the write, is cut off the file.
+    """
+    for segment in list_segments(directory):
+        if segment < first_segment:
+            continue
+        file_name = get_segment_file_name(directory, segment)
+        with open(file_name, "rb") as file:
+            data = file.read()
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            length, crc = HEADER.unpack_from(data, offset)
+            payload = data[offset + HEADER.size:offset + HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            yield payload
+            offset += HEADER.size + length
+        if offset < len(data):
+            logger.info("WAL segment %s has a torn tail, truncating %s bytes", file_name, len(data) - offset)
+            with open(file_name, "r+b") as file:
+                file.truncate(offset)
+
+def remove_segments(directory, before_segment):
+    """
+    Delete the segments covered by a snapshot
+    """
+    for segment in list_segments(directory):
+        if segment < before_segment:
+            os.remove(get_segment_file_name(directory, segment))
+
+def load_snapshot(directory):
+    """
+    Return the snapshot of the directory, None if there is none
+    """
+    file_name = os.path.join(directory, SNAPSHOT_FILE_NAME)
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name) as file:
+        return json.load(file)
+
+def write_snapshot(directory, snapshot):
+    """
+    Write the snapshot durably, the file is replaced atomically so a crash leaves the old or the new snapshot
+    """
+    file_name = os.path.join(directory, SNAPSHOT_FILE_NAME)
+    temp_file_name = "{}.tmp".format(file_name)
+    with open(temp_file_name, "w") as file:
+        json.dump(snapshot, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file_name, file_name)
+    fsync_directory(directory)
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteAheadLog:
+    """
+    Append-only log of the branch writes with group commit
+    append only queues the record, a flusher thread writes every queued record and makes them durable
+    with one fsync, so concurrent writers share the fsync instead of paying one each. wait blocks until
+    the record is durable.
+    """
+
+    def __init__(self, directory, segment, sync_interval=0.0, metrics=None):
+        self.directory = directory
+        self.segment = segment
+        # seconds the flusher waits after the first queued record to gather more records into the fsync
+        self.sync_interval = sync_interval
+        self.metrics = metrics
+        self.file = open(get_segment_file_name(directory, segment), "ab")
+        fsync_directory(directory)
+        # encoded records waiting for the flusher
+        self.buffer = []
+        # log sequence numbers, number of records appended and number of records durable
+        self.appended_lsn = 0
+        self.durable_lsn = 0
+        self.closed = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.flusher = threading.Thread(target=self.flush_service, name="WAL-flusher", daemon=True)
+        self.flusher.start()
+
+    def append(self, payload):
+        """
+        Queue the record, return its log sequence number
+        """
+        record = HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.cond:
+            self.buffer.append(record)
+            self.appended_lsn += 1
+            self.cond.notify_all()
+            return self.appended_lsn
+
+    def wait(self, lsn=None):
+        """
+        Wait until the record lsn, or every record appended so far, is durable
+        """
+        with self.cond:
+            if lsn is None:
+                lsn = self.appended_lsn
+            self.cond.wait_for(lambda: self.durable_lsn >= lsn or self.error is not None)
+            if self.durable_lsn < lsn:
+                raise self.error
+
+    def flush_service(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.buffer or self.closed)
+                if not self.buffer and self.closed:
+                    return
+            if self.sync_interval > 0:
+                time.sleep(self.sync_interval)
+            with self.cond:
+                records = self.buffer
+                self.buffer = []
+                lsn = self.appended_lsn
+                file = self.file
+            start_time = time.perf_counter()
+            try:
+                file.write(b"".join(records))
+                file.flush()
+                os.fsync(file.fileno())
+            except OSError as e:
+                logger.error("WAL write to %s failed with %s", file.name, e)
+                with self.cond:
+                    self.error = e
+                    self.cond.notify_all()
+                return
+            if self.metrics is not None:
+                self.metrics.histogram("wal_fsync_seconds").observe(time.perf_counter() - start_time)
+                self.metrics.histogram("wal_group_commit_records", [1, 2, 4, 8, 16, 32, 64, 128, 256]).observe(len(records))
+            with self.cond:
+                self.durable_lsn = lsn
+                self.cond.notify_all()
+
+    def roll(self):
+        """
+        Make every queued record durable and continue in a new segment, return the new segment number
+        Caller must make sure nothing is appended meanwhile.
+        """
+        self.wait()
+        with self.cond:
+            self.file.close()
+            self.segment += 1
+            self.file = open(get_segment_file_name(self.directory, self.segment), "ab")
+        fsync_directory(self.directory)
+        return self.segment
+
+    def close(self):
+        self.wait()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.flusher.join()
+        self.file.close()
@@ -0,0 +1,127 @@
+import bank_pb2
+
+class WriteRecord:
+    """
+    Compact applied write, the fields of the propagate request Sync needs to rebuild it
+    """
+    __slots__ = ("operation_type", "amount", "clock", "write_id", "write_set")
+
+    def __init__(self, request):
+        self.operation_type = request.operation_type
+        self.amount = request.amount
+        self.clock = request.clock
+        self.write_id = request.last_write_id
+        # write_set version vector as sorted (branch id, count) pairs
+        self.write_set = tuple(sorted(request.write_set.items()))
+
+    def to_request(self, customer_id, origin, write_count=0):
+        return bank_pb2.MsgDelivery_request(
+            operation_type = self.operation_type,
+            source_type = bank_pb2.Source.branch,
+            id = customer_id,
+            amount = self.amount,
+            clock = self.clock,
+            last_write_id = self.write_id,
+            last_write_branch = origin,
+            write_set = dict(self.write_set),
+            write_count = write_count
+        )
+
+
+class WriteLog:
+    """
+    Applied writes of one customer from one origin branch, in origin order
+    Writes every replica has acknowledged are truncated, base is the number of writes dropped from the front.
+    The truncated writes are kept merged into one, their net amount and the last of them, for the state transfer
+    to a branch which has lost every write.
+    """
+    __slots__ = ("base", "records", "truncated_amount", "truncated_last")
+
+    def __init__(self):
+        self.base = 0
+        self.records = []
+        # net amount of the truncated writes, deposits are positive and withdraws negative
+        self.truncated_amount = 0
+        # last truncated record, None if nothing is truncated
+        self.truncated_last = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def append(self, request):
+        if request.write_count:
+            #merged truncated writes of a Sync state transfer, the log starts after them
+            self.base += request.write_count
+            self.truncated_amount += -request.amount if request.operation_type == bank_pb2.Operation.withdraw else request.amount
+            self.truncated_last = WriteRecord(request)
+            return
+        self.records.append(WriteRecord(request))
+
+    def since(self, count):
+        """
+        Records after the first count writes, None if some of them are truncated already
+        """
+        if count < self.base:
+            return None
+        return self.records[count - self.base:]
+
+    def truncate(self, count):
+        """
+        Drop the first count writes, return the number of records dropped
+        """
+        dropped = min(count - self.base, len(self.records))
+        if dropped <= 0:
+            return 0
+        for record in self.records[:dropped]:
+            if record.operation_type == bank_pb2.Operation.withdraw:
+                self.truncated_amount -= record.amount
+            else:
+                self.truncated_amount += record.amount
+        self.truncated_last = self.records[dropped - 1]
+        del self.records[:dropped]
+        self.base += dropped
+        return dropped
+
+    def merged_request(self, customer_id, origin):
+        """
+        Propagate request standing for every truncated write, None if nothing is truncated
+        """
+        if self.truncated_last is None:
+            return None
+        request = self.truncated_last.to_request(customer_id, origin, self.base)
+        request.operation_type = bank_pb2.Operation.deposit if self.truncated_amount >= 0 else bank_pb2.Operation.withdraw
+        request.amount = abs(self.truncated_amount)
+        return request
+
+    def to_state(self):
+        """
+        Json serializable state of the log for snapshots
+        """
+        return [self.base, [
+            record_to_state(record) for record in self.records
+        ], self.truncated_amount, None if self.truncated_last is None else record_to_state(self.truncated_last)]
+
+    @classmethod
+    def from_state(cls, state):
+        log = cls()
+        log.base = state[0]
+        log.records = [record_from_state(record) for record in state[1]]
+        #snapshots written before the merged truncated writes have only the base and the records
+        if len(state) > 2:
+            log.truncated_amount = state[2]
+            log.truncated_last = None if state[3] is None else record_from_state(state[3])
+        return log
+
+
+def record_to_state(record):
+    return [record.operation_type, record.amount, record.clock, record.write_id, [list(pair) for pair in record.write_set]]
+
+def record_from_state(state):
+    operation_type, amount, clock, write_id, write_set = state
+    record = WriteRecord.__new__(WriteRecord)
+    record.operation_type = operation_type
+    record.amount = amount
+    record.clock = clock
+    record.write_id = write_id
+    record.write_set = tuple(tuple(pair) for pair in write_set)
+    return record